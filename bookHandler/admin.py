@@ -1,20 +1,149 @@
 from django.contrib import admin
-from .models import AbstractBook, ActualBook, Genre, Author, Transaction, User, Message
+from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
+from .models import AbstractBook, ActualBook, Genre, Author, Transaction, User, Message, Comment, SearchToken, Job
+from .models import TrendingBook, RelatedBook, RelatedBooksRefresh, MonthlyReport, ApiToken
+from .paginators import ApproximateCountPaginator
 
 admin.site.site_header = 'Niseko Book Club'
 admin.site.site_title = 'Niseko Book Club Admin Page'
 
-admin.site.register(AbstractBook)
-admin.site.register(Genre)
-admin.site.register(Author)
-admin.site.register(Transaction)
-admin.site.register(User)
-admin.site.register(Message)
+
+# The lists of the large tables load the related objects they display in the same query (list_select_related), filter
+# on indexed columns, select the related objects with raw id widgets (instead of a <select> of the whole table) and
+# do not count the whole table for each page (see paginators.py).
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = ApproximateCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(User)
+class UserAdmin(BaseUserAdmin):
+    list_display = ('username', 'email', 'location', 'is_staff', 'date_joined')
+    fieldsets = BaseUserAdmin.fieldsets + (('Club', {'fields': ('location',)}),)
+    paginator = ApproximateCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(Genre)
+class GenreAdmin(admin.ModelAdmin):
+    list_display = ('name',)
+    search_fields = ('name',)
+
+
+@admin.register(Author)
+class AuthorAdmin(LargeTableAdmin):
+    list_display = ('last_name', 'first_name', 'modified')
+    search_fields = ('last_name', 'first_name')
+    readonly_fields = ('name_key', 'modified')
+
+
+@admin.register(AbstractBook)
+class AbstractBookAdmin(LargeTableAdmin):
+    list_display = ('title', 'isbn', 'available_copies', 'total_copies', 'lifetime_borrows', 'active_requests', 'modified')
+    search_fields = ('title', '=isbn13')
+    raw_id_fields = ('author',)
+    filter_horizontal = ('genre',)
+    readonly_fields = ('isbn13', 'modified', 'available_copies', 'total_copies', 'lifetime_borrows', 'active_requests')
+
 
 @admin.register(ActualBook)
-class ActualBookAdmin(admin.ModelAdmin):
+class ActualBookAdmin(LargeTableAdmin):
     list_display = ('id','get_book_title','created_date', 'owner', 'status')
+    list_select_related = ('abstract_book', 'owner')
+    list_filter = ('status',)
+    search_fields = ('abstract_book__title', '=owner__username')
+    raw_id_fields = ('abstract_book', 'owner')
 
     def get_book_title(self, actual_book):
         return actual_book.abstract_book.title
-    get_book_title.short_description = 'Title'
\ No newline at end of file
+    get_book_title.short_description = 'Title'
+    get_book_title.admin_order_field = 'abstract_book__title'
+
+
+@admin.register(Transaction)
+class TransactionAdmin(LargeTableAdmin):
+    list_display = ('id', 'get_book_title', 'lender', 'borrower', 'transaction_state', 'lend_date', 'return_date')
+    list_select_related = ('book__abstract_book', 'lender', 'borrower')
+    list_filter = ('transaction_state',)
+    search_fields = ('book__abstract_book__title', '=lender__username', '=borrower__username')
+    raw_id_fields = ('book', 'lender', 'borrower')
+
+    def get_book_title(self, book_transaction):
+        return book_transaction.book.abstract_book.title
+    get_book_title.short_description = 'Title'
+    get_book_title.admin_order_field = 'book__abstract_book__title'
+
+    def save_model(self, request, obj, form, change):
+        # Same as the pages of the site: the status of the copy and the counters of the book follow the transaction
+        super(TransactionAdmin,self).save_model(request, obj, form, change)
+        obj.update_actual_book_status()
+
+
+@admin.register(Message)
+class MessageAdmin(LargeTableAdmin):
+    list_display = ('timestamp', 'author', 'destination', 'text', 'read')
+    list_select_related = ('author', 'destination')
+    list_filter = ('read',)
+    search_fields = ('=author__username', '=destination__username')
+    raw_id_fields = ('author', 'destination', 'transaction')
+
+
+@admin.register(Comment)
+class CommentAdmin(LargeTableAdmin):
+    list_display = ('timestamp', 'author', 'text', 'read')
+    list_select_related = ('author',)
+    list_filter = ('read',)
+    search_fields = ('=author__username',)
+    raw_id_fields = ('author',)
+
+
+@admin.register(SearchToken)
+class SearchTokenAdmin(LargeTableAdmin):
+    list_display = ('token', 'book', 'weight')
+    list_select_related = ('book',)
+    search_fields = ('=token',)
+    raw_id_fields = ('book',)
+
+
+@admin.register(Job)
+class JobAdmin(LargeTableAdmin):
+    list_display = ('id', 'name', 'status', 'attempts', 'created', 'run_after', 'started', 'finished')
+    list_filter = ('status',)
+    search_fields = ('=name',)
+
+
+@admin.register(TrendingBook)
+class TrendingBookAdmin(admin.ModelAdmin):
+    list_display = ('rank', 'book', 'score', 'computed')
+    list_select_related = ('book',)
+    raw_id_fields = ('book',)
+
+
+@admin.register(RelatedBook)
+class RelatedBookAdmin(LargeTableAdmin):
+    list_display = ('book', 'rank', 'related', 'score', 'common_borrowers', 'computed')
+    list_select_related = ('book', 'related')
+    raw_id_fields = ('book', 'related')
+
+
+@admin.register(RelatedBooksRefresh)
+class RelatedBooksRefreshAdmin(admin.ModelAdmin):
+    list_display = ('computed', 'full', 'books', 'rows', 'duration')
+    list_filter = ('full',)
+
+
+@admin.register(MonthlyReport)
+class MonthlyReportAdmin(admin.ModelAdmin):
+    list_display = ('month', 'computed')
+    # The snapshots are never changed once written (see reports.py)
+    readonly_fields = ('month', 'data', 'computed')
+
+
+@admin.register(ApiToken)
+class ApiTokenAdmin(admin.ModelAdmin):
+    list_display = ('user', 'name', 'created')
+    # The keys are created through the API (see api.py), the admin can only revoke them
+    readonly_fields = ('user', 'name', 'created')
+
+    def has_add_permission(self, request):
+        return False
@@ -0,0 +1,513 @@
+""" JSON API used by the mobile client, under /bookhandler/api/.
+
+Every collection supports:
+    ?fields=id,title         only returns these fields (see the fields of each resource)
+    ?limit=50&cursor=...     cursor (keyset) pagination, the cursor of the next page is returned as 'next'
+    ?ids=1,2,3               batched fetch of up to API_MAX_IDS objects, returned in the requested order
+plus some filters (e.g. /api/copies?book=12). The related objects are loaded with select_related / prefetch_related,
+only for the selected fields, so the cost of a page is a fixed number of queries whatever its size.
+
+The responses carry an ETag and a request with a matching If-None-Match gets an empty 304 response.
+Writing (POST / PATCH with a JSON body) requires the member to be logged in, and goes through the same forms and model
+methods as the HTML pages.
+
+Authentication: the web pages use the session cookie, whose writes need the CSRF token (X-CSRFToken header) as for
+the HTML forms. The mobile client gets a token with POST /api/token {"username", "password", "name"} and sends it in
+an 'Authorization: Token <key>' header, without cookie nor CSRF token; DELETE /api/token revokes the token used.
+"""
+import base64
+import hashlib
+import json
+from functools import wraps
+
+from django.contrib.auth import authenticate
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q, Prefetch
+from django.http import HttpResponse, JsonResponse
+from django.middleware.csrf import CsrfViewMiddleware
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.views.decorators.csrf import csrf_exempt
+
+from .forms import UserBookForm, EditTransactionForm, NewMessageForm
+from .jobs import enqueue
+from .models import AbstractBook, ActualBook, Author, Transaction, Message, ApiToken
+from .trending import get_trending_books
+
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 200
+API_MAX_IDS = 100
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super(ApiError,self).__init__(message)
+        self.message = message
+        self.status = status
+
+
+class Resource:
+    """ How one model is exposed by the API.
+        fields: name -> function returning the JSON value of the field for an object
+        related: field name -> ('select' or 'prefetch', lookup) loading what the field needs
+        filters: query parameter -> lookup
+        ordering: fields of the cursor pagination, the last one must be unique
+    """
+    def __init__(self, model, fields, default_fields=None, related=None, filters=None, ordering=('id',), private=False):
+        self.model = model
+        self.fields = fields
+        self.default_fields = default_fields or list(fields)
+        self.related = related or {}
+        self.filters = filters or {}
+        self.ordering = list(ordering)
+        self.private = private
+
+    def get_queryset(self, request, fields):
+        queryset = self.model.objects.all()
+        if self.private:
+            if not request.user.is_authenticated:
+                raise ApiError('Authentication required', 401)
+            queryset = self.visible_to(queryset, request.user)
+        for field in fields:
+            if field in self.related:
+                kind, lookup = self.related[field]
+                queryset = queryset.select_related(lookup) if kind == 'select' else queryset.prefetch_related(lookup)
+        return queryset
+
+    def visible_to(self, queryset, user):
+        return queryset
+
+    def serialize(self, obj, fields):
+        return {field: self.fields[field](obj) for field in fields}
+
+
+class TransactionResource(Resource):
+    def visible_to(self, queryset, user):
+        return queryset.filter(Q(lender=user) | Q(borrower=user))
+
+
+class MessageResource(Resource):
+    def visible_to(self, queryset, user):
+        return queryset.filter(Q(author=user) | Q(destination=user))
+
+
+def _username(user):
+    return user.username if user else None
+
+
+BOOKS = Resource(AbstractBook,
+    fields={
+        'id': lambda book: book.id,
+        'title': lambda book: book.title,
+        'summary': lambda book: book.summary,
+        'isbn': lambda book: book.isbn13,
+        'authors': lambda book: [{'id': author.id, 'name': str(author)} for author in book.author.all()],
+        'genres': lambda book: [genre.name for genre in book.genre.all()],
+        'available_copies': lambda book: book.available_copies,
+        'total_copies': lambda book: book.total_copies,
+        'lifetime_borrows': lambda book: book.lifetime_borrows,
+        'active_requests': lambda book: book.active_requests,
+        'url': lambda book: book.get_absolute_url(),
+    },
+    related={'authors': ('prefetch', 'author'), 'genres': ('prefetch', 'genre')},
+    filters={'author': 'author'})
+
+AUTHORS = Resource(Author,
+    fields={
+        'id': lambda author: author.id,
+        'first_name': lambda author: author.first_name,
+        'last_name': lambda author: author.last_name,
+        'name': lambda author: str(author),
+        'books': lambda author: [book.id for book in author.abstractbook_set.all()],
+    },
+    related={'books': ('prefetch', Prefetch('abstractbook_set', queryset=AbstractBook.objects.only('id').order_by('id')))})
+
+COPIES = Resource(ActualBook,
+    fields={
+        'id': lambda copy: copy.id,
+        'book': lambda copy: copy.abstract_book_id,
+        'title': lambda copy: copy.abstract_book.title,
+        'owner': lambda copy: _username(copy.owner),
+        'location': lambda copy: copy.owner.get_location_display() if copy.owner else None,
+        'status': lambda copy: copy.status,
+        'created_date': lambda copy: copy.created_date,
+    },
+    related={'title': ('select', 'abstract_book'), 'owner': ('select', 'owner'), 'location': ('select', 'owner')},
+    filters={'book': 'abstract_book', 'owner': 'owner__username', 'status': 'status'})
+
+TRANSACTIONS = TransactionResource(Transaction,
+    fields={
+        'id': lambda t: t.id,
+        'copy': lambda t: t.book_id,
+        'title': lambda t: t.book.abstract_book.title,
+        'lender': lambda t: _username(t.lender),
+        'borrower': lambda t: _username(t.borrower),
+        'state': lambda t: t.transaction_state,
+        'state_label': lambda t: t.get_transaction_state_display(),
+        'allowed_states': lambda t: t.allowed_states(),
+        'created_date': lambda t: t.created_date,
+        'lend_date': lambda t: t.lend_date,
+        'return_date': lambda t: t.return_date,
+        'modified': lambda t: t.modified_timestamp,
+    },
+    related={'title': ('select', 'book__abstract_book'), 'lender': ('select', 'lender'), 'borrower': ('select', 'borrower')},
+    filters={'state': 'transaction_state', 'copy': 'book'},
+    ordering=('-modified_timestamp', '-id'), private=True)
+
+MESSAGES = MessageResource(Message,
+    fields={
+        'id': lambda message: message.id,
+        'transaction': lambda message: message.transaction_id,
+        'author': lambda message: _username(message.author),
+        'destination': lambda message: _username(message.destination),
+        'text': lambda message: message.text,
+        'read': lambda message: message.read,
+        'timestamp': lambda message: message.timestamp,
+    },
+    related={'author': ('select', 'author'), 'destination': ('select', 'destination')},
+    filters={'transaction': 'transaction'},
+    ordering=('-timestamp', '-id'), private=True)
+
+
+# Helpers
+
+# The CSRF check of the requests authenticated by the session, the API views being exempted from the middleware's one
+_csrf_check = CsrfViewMiddleware(lambda request: None)
+
+
+def _authenticate(request):
+    """ Authenticates the request with its 'Authorization: Token <key>' header if any, otherwise checks the CSRF
+        token of the writes authenticated by the session cookie
+    """
+    request.api_token = None
+    header = request.META.get('HTTP_AUTHORIZATION', '')
+    if header:
+        kind, _, key = header.partition(' ')
+        if kind.lower() != 'token' or not key.strip():
+            raise ApiError('Invalid Authorization header, expected "Token <key>"', 401)
+        api_token = ApiToken.authenticate(key.strip())
+        if api_token is None:
+            raise ApiError('Invalid token', 401)
+        request.user = api_token.user
+        request.api_token = api_token
+    elif request.method != 'GET' and request.user.is_authenticated:
+        if _csrf_check.process_view(request, None, (), {}) is not None:
+            raise ApiError('CSRF token missing or incorrect', 403)
+
+
+def api_view(methods, anonymous_writes=False):
+    """ Decorator of the API views: checks the HTTP method and the authentication of the writes (unless
+        anonymous_writes), and turns the errors into JSON responses
+    """
+    def decorator(view):
+        @csrf_exempt
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                response = JsonResponse({'error': 'Method not allowed'}, status=405)
+                response['Allow'] = ', '.join(methods)
+                return response
+            try:
+                _authenticate(request)
+                if request.method != 'GET' and not anonymous_writes and not request.user.is_authenticated:
+                    raise ApiError('Authentication required', 401)
+                return view(request, *args, **kwargs)
+            except ApiError as e:
+                return JsonResponse({'error': e.message}, status=e.status)
+            except ValidationError as e:
+                return JsonResponse({'error': e.messages}, status=400)
+        return wrapper
+    return decorator
+
+
+def _json_response(request, data, private=False, status=200):
+    body = json.dumps(data, cls=DjangoJSONEncoder)
+    response = HttpResponse(body, content_type='application/json', status=status)
+    if private:
+        patch_cache_control(response, private=True)
+    if request.method == 'GET':
+        etag = '"%s"' % hashlib.md5(body.encode()).hexdigest()
+        response['ETag'] = etag
+        return get_conditional_response(request, etag=etag, response=response)
+    return response
+
+
+def _json_body(request):
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        raise ApiError('Invalid JSON body')
+    if not isinstance(data, dict):
+        raise ApiError('The body must be a JSON object')
+    return data
+
+
+def _form_errors(form):
+    return ApiError({field: errors for field, errors in form.errors.items()})
+
+
+def _selected_fields(request, resource):
+    if not request.GET.get('fields'):
+        return resource.default_fields
+    fields = [field.strip() for field in request.GET['fields'].split(',') if field.strip()]
+    unknown = [field for field in fields if field not in resource.fields]
+    if unknown:
+        raise ApiError('Unknown fields: %s' % ', '.join(unknown))
+    return fields
+
+
+def _to_python(model, field_name, value):
+    try:
+        return model._meta.get_field(field_name).to_python(value)
+    except ValidationError:
+        raise ApiError('Invalid value "%s"' % value)
+
+
+def _encode_cursor(resource, obj):
+    values = []
+    for name in resource.ordering:
+        value = getattr(obj, name.lstrip('-'))
+        # isoformat keeps the microseconds, which DjangoJSONEncoder would truncate
+        values.append(value.isoformat() if hasattr(value, 'isoformat') else str(value))
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def _after_cursor(queryset, resource, cursor):
+    """ Keeps the objects after the cursor, in the ordering of the resource """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise ApiError('Invalid cursor')
+    # The cursors are lists of strings (see _encode_cursor)
+    if (not isinstance(values, list) or len(values) != len(resource.ordering)
+            or not all(isinstance(value, str) for value in values)):
+        raise ApiError('Invalid cursor')
+    condition = None
+    equal = {}
+    for name, value in zip(resource.ordering, values):
+        field = name.lstrip('-')
+        value = _to_python(resource.model, field, value)
+        after = Q(**{'%s__%s' % (field, 'lt' if name.startswith('-') else 'gt'): value}, **equal)
+        condition = after if condition is None else condition | after
+        equal[field] = value
+    return queryset.filter(condition)
+
+
+def _list(request, resource):
+    fields = _selected_fields(request, resource)
+    queryset = resource.get_queryset(request, fields)
+    for parameter, lookup in resource.filters.items():
+        if request.GET.get(parameter):
+            try:
+                queryset = queryset.filter(**{lookup: request.GET[parameter]})
+            except (ValueError, ValidationError):
+                raise ApiError('Invalid value for "%s"' % parameter)
+
+    if request.GET.get('ids'):
+        # Batched fetch, e.g. to refresh the objects cached by the client
+        pk_name = resource.model._meta.pk.name
+        ids = [_to_python(resource.model, pk_name, value.strip()) for value in request.GET['ids'].split(',') if value.strip()]
+        if len(ids) > API_MAX_IDS:
+            raise ApiError('At most %d ids can be fetched at once' % API_MAX_IDS)
+        objects = {obj.pk: obj for obj in queryset.filter(pk__in=ids).order_by()}
+        data = {
+            'results': [resource.serialize(objects[pk], fields) for pk in ids if pk in objects],
+            'missing': [pk for pk in ids if pk not in objects],
+        }
+        return _json_response(request, data, resource.private)
+
+    try:
+        limit = min(int(request.GET.get('limit', API_PAGE_SIZE)), API_MAX_PAGE_SIZE)
+    except ValueError:
+        raise ApiError('Invalid limit')
+    if limit < 1:
+        raise ApiError('Invalid limit')
+    if request.GET.get('cursor'):
+        queryset = _after_cursor(queryset, resource, request.GET['cursor'])
+    page = list(queryset.order_by(*resource.ordering)[:limit+1])
+    next_cursor = _encode_cursor(resource, page[limit-1]) if len(page) > limit else None
+    data = {
+        'results': [resource.serialize(obj, fields) for obj in page[:limit]],
+        'next': next_cursor,
+    }
+    return _json_response(request, data, resource.private)
+
+
+def _get_object(request, resource, pk, fields=None, for_update=False):
+    fields = fields if fields is not None else resource.fields
+    queryset = resource.get_queryset(request, fields)
+    if for_update:
+        queryset = queryset.select_for_update()
+    obj = queryset.filter(pk=pk).first()
+    if obj is None:
+        raise ApiError('Not found', 404)
+    return obj
+
+
+def _detail(request, resource, pk):
+    fields = _selected_fields(request, resource)
+    return _json_response(request, resource.serialize(_get_object(request, resource, pk, fields), fields), resource.private)
+
+
+def _created(request, resource, obj):
+    obj = _get_object(request, resource, obj.pk)
+    return _json_response(request, resource.serialize(obj, resource.default_fields), resource.private, status=201)
+
+
+# Views
+
+@api_view(['POST', 'DELETE'], anonymous_writes=True)
+def token(request):
+    if request.method == 'DELETE':
+        # Revokes the token authenticating the request, e.g. when the member logs out of the mobile client
+        if request.api_token is None:
+            raise ApiError('Authentication with a token required', 401)
+        request.api_token.delete()
+        return HttpResponse(status=204)
+    data = _json_body(request)
+    if not isinstance(data.get('username'), str) or not isinstance(data.get('password'), str):
+        raise ApiError('The username and the password are required')
+    user = authenticate(request, username=data['username'], password=data['password'])
+    if user is None:
+        raise ApiError('Invalid username or password', 401)
+    key = ApiToken.create_key(user, name=str(data.get('name', ''))[:100])
+    return _json_response(request, {'token': key, 'username': user.username}, private=True, status=201)
+
+
+@api_view(['GET', 'POST'])
+def books(request):
+    if request.method == 'POST':
+        # Adds a title to the catalogue (without a physical copy, see copies)
+        form = UserBookForm(_json_body(request))
+        if not form.is_valid():
+            raise _form_errors(form)
+        book = AbstractBook.get_or_create(form.cleaned_data['title'], form.cleaned_data['author'].split(','),
+            book_summary=form.cleaned_data['summary'], isbn=form.cleaned_data['isbn'])
+        return _created(request, BOOKS, book)
+    return _list(request, BOOKS)
+
+
+@api_view(['GET'])
+def book(request, book_id):
+    return _detail(request, BOOKS, book_id)
+
+
+@api_view(['GET'])
+def trending_books(request):
+    # Precomputed ranking (see trending.py), not paginated
+    trending = get_trending_books()
+    return _json_response(request, {'computed': trending['computed'], 'results': trending['books']})
+
+
+@api_view(['GET'])
+def authors(request):
+    # The authors are created together with the books
+    return _list(request, AUTHORS)
+
+
+@api_view(['GET'])
+def author(request, author_id):
+    return _detail(request, AUTHORS, author_id)
+
+
+@api_view(['GET', 'POST'])
+def copies(request):
+    if request.method == 'POST':
+        # New copy owned by the member, of an existing title ('book') or of the title described by the body
+        data = _json_body(request)
+        if data.get('book'):
+            abstract_book = AbstractBook.objects.filter(id=_to_python(AbstractBook, 'id', data['book'])).first()
+            if abstract_book is None:
+                raise ApiError('Unknown book %s' % data['book'])
+        else:
+            form = UserBookForm(data)
+            if not form.is_valid():
+                raise _form_errors(form)
+            abstract_book = AbstractBook.get_or_create(form.cleaned_data['title'], form.cleaned_data['author'].split(','),
+                book_summary=form.cleaned_data['summary'], isbn=form.cleaned_data['isbn'])
+        copy = ActualBook.objects.create(abstract_book=abstract_book, owner=request.user)
+        return _created(request, COPIES, copy)
+    return _list(request, COPIES)
+
+
+@api_view(['GET', 'PATCH'])
+def copy(request, copy_id):
+    if request.method == 'PATCH':
+        # The owner can take a copy out of the club or put it back. Lent copies are managed by their transaction.
+        status = _json_body(request).get('status')
+        if status not in (ActualBook.AVAILABLE, ActualBook.UNAVAILABLE):
+            raise ApiError('The status can only be changed to "%s" or "%s"' % (ActualBook.AVAILABLE, ActualBook.UNAVAILABLE))
+        with transaction.atomic():
+            actual_book = _get_object(request, COPIES, copy_id, fields=[], for_update=True)
+            if actual_book.owner_id != request.user.id:
+                raise ApiError("You cannot edit a book you don't own", 403)
+            if actual_book.status == ActualBook.OUT_FOR_RENT:
+                raise ApiError('The book is currently borrowed', 409)
+            actual_book.status = status
+            actual_book.save(update_fields=['status', 'modified'])
+    return _detail(request, COPIES, copy_id)
+
+
+@api_view(['GET', 'POST'])
+def transactions(request):
+    if request.method == 'POST':
+        # Borrowing request of the member for a copy, same as new_borrowing_request
+        data = _json_body(request)
+        actual_book = ActualBook.objects.filter(id=_to_python(ActualBook, 'id', data.get('copy'))).first()
+        if actual_book is None:
+            raise ApiError('Unknown copy %s' % data.get('copy'), 404)
+        try:
+            with transaction.atomic():
+                new_request = Transaction.create_request(actual_book, request.user)
+                enqueue('notify_new_request', transaction_id=str(new_request.id))
+        except ValidationError as e:
+            raise ApiError(e.message, 409 if e.code == 'not_available' else 400)
+        return _created(request, TRANSACTIONS, new_request)
+    return _list(request, TRANSACTIONS)
+
+
+@api_view(['GET', 'PATCH'])
+def transaction_detail(request, transaction_id):
+    if request.method == 'PATCH':
+        # Update of the state or the dates by the lender, same as edit_transaction
+        data = _json_body(request)
+        with transaction.atomic():
+            book_transaction = _get_object(request, TRANSACTIONS, transaction_id, fields=[], for_update=True)
+            if book_transaction.lender_id != request.user.id:
+                raise ApiError("You cannot edit a transaction on books you don't own", 403)
+            form = EditTransactionForm({
+                'lend_date': data.get('lend_date', book_transaction.lend_date),
+                'return_date': data.get('return_date', book_transaction.return_date),
+                'transaction_state': data.get('state', book_transaction.transaction_state),
+                'new_message': data.get('message', ''),
+            }, instance=book_transaction)
+            if not form.is_valid():
+                raise _form_errors(form)
+            book_transaction.save()
+            book_transaction.update_actual_book_status()
+            if form.cleaned_data['new_message']:
+                Message.objects.create(author=request.user, destination=book_transaction.borrower, transaction=book_transaction,
+                    text=form.cleaned_data['new_message'])
+    return _detail(request, TRANSACTIONS, transaction_id)
+
+
+@api_view(['GET', 'POST'])
+def messages(request):
+    if request.method == 'POST':
+        # Message to the other participant of a transaction
+        data = _json_body(request)
+        book_transaction = _get_object(request, TRANSACTIONS, data.get('transaction'), fields=[])
+        form = NewMessageForm({'message_text': data.get('text', '')})
+        if not form.is_valid() or not form.cleaned_data['message_text']:
+            raise ApiError('The message text is required')
+        destination = book_transaction.borrower if request.user == book_transaction.lender else book_transaction.lender
+        message = Message.objects.create(author=request.user, destination=destination, transaction=book_transaction,
+            text=form.cleaned_data['message_text'])
+        return _created(request, MESSAGES, message)
+    return _list(request, MESSAGES)
+
+
+@api_view(['GET'])
+def message(request, message_id):
+    return _detail(request, MESSAGES, message_id)
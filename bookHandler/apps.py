@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class BookhandlerConfig(AppConfig):
     name = 'bookHandler'
+
+    def ready(self):
+        # Registering the signal handlers maintaining the search index, the cache versions, the unread counters,
+        # the timestamps of the catalogue pages and the cached trending books
+        from . import search, fragment_cache, unread, conditional, trending
@@ -0,0 +1,53 @@
+""" Helpers to time requests against the current database, used by the benchmark management commands """
+import time
+from statistics import median
+
+from django.conf import settings
+from django.db import connection
+from django.test import Client
+
+
+def make_client(user=None):
+    """ Test client sending a host accepted by ALLOWED_HOSTS, logged in as user if given """
+    hosts = [host for host in settings.ALLOWED_HOSTS if host not in ('*', '') and not host.startswith('.')]
+    client = Client(HTTP_HOST=hosts[0] if hosts else 'localhost')
+    if user is not None:
+        client.force_login(user)
+    return client
+
+
+def time_url(client, url, repeat=20):
+    """ Requests url repeat times (after one warm-up request) and returns a dict with the status code, the number of
+        SQL queries of the last request and the median / 95th percentile / max latency in milliseconds
+    """
+    queries = []
+
+    def count_query(execute, sql, params, many, context):
+        queries.append(sql)
+        return execute(sql, params, many, context)
+
+    response = client.get(url)
+    timings = []
+    for _ in range(repeat):
+        del queries[:]
+        with connection.execute_wrapper(count_query):
+            start = time.perf_counter()
+            response = client.get(url)
+            timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        'url': url,
+        'status': response.status_code,
+        'queries': len(queries),
+        'median_ms': median(timings),
+        'p95_ms': timings[min(len(timings)-1, int(len(timings)*0.95))],
+        'max_ms': timings[-1],
+    }
+
+
+def format_results(results):
+    lines = ['%-50s %6s %8s %10s %10s %10s' % ('url', 'status', 'queries', 'median ms', 'p95 ms', 'max ms')]
+    for result in results:
+        lines.append('%-50s %6d %8d %10.2f %10.2f %10.2f' % (result['url'][:50], result['status'], result['queries'],
+            result['median_ms'], result['p95_ms'], result['max_ms']))
+    return '\n'.join(lines)
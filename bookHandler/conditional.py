@@ -0,0 +1,178 @@
+""" HTTP conditional GET and Cache-Control for the catalogue pages (book index, book and author pages).
+
+For anonymous visitors the pages get a Last-Modified header, the latest 'modified' timestamp of the objects they
+display, and an ETag combining that timestamp with the fragment cache versions (see fragment_cache.py, they also change
+when something displayed is deleted). A browser or a reverse proxy revalidating a page gets an empty 304 response for
+the cost of one or two small queries, and the pages are public for CATALOGUE_MAX_AGE seconds.
+The pages of logged in members show personal data (unread messages, ...) so they are always rendered and private.
+
+The signal handlers below update the 'modified' timestamps of the objects whose pages change when a related object
+changes, e.g. the book page when a copy is added or when one of its authors is renamed.
+"""
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+
+from .fragment_cache import get_version, CATALOGUE, FRAGMENT_CACHE_TIMEOUT
+from .models import AbstractBook, ActualBook, Author, Genre, RelatedBook
+from .trending import get_trending_books
+
+
+def _latest(*timestamps):
+    timestamps = [timestamp for timestamp in timestamps if timestamp is not None]
+    return max(timestamps) if timestamps else None
+
+
+def _latest_of(queryset, field='modified'):
+    return Subquery(queryset.order_by('-%s' % field).values(field)[:1])
+
+
+def book_index_state():
+    """ Returns (last modified, versions) of the book index, which lists the titles and their authors, and the
+        trending books. Every change of the index bumps the catalogue version, so the timestamp is kept in the cache
+        with that version
+    """
+    version = get_version(CATALOGUE)
+    cache_key = 'book_index_modified:%d' % version
+    last_modified = cache.get(cache_key)
+    if last_modified is None:
+        last_modified = _latest(AbstractBook.objects.aggregate(latest=Max('modified'))['latest'],
+            Author.objects.aggregate(latest=Max('modified'))['latest'])
+        cache.set(cache_key, last_modified, FRAGMENT_CACHE_TIMEOUT)
+    trending_computed = get_trending_books()['computed']
+    return _latest(last_modified, trending_computed), [version, trending_computed and trending_computed.timestamp()]
+
+
+def abstract_book_state(book_id):
+    """ The book page shows the book, its authors and genres, its copies and the related books.
+        None if the book does not exist
+    """
+    related = RelatedBook.objects.filter(book=OuterRef('pk'))
+    row = (AbstractBook.objects.filter(id=book_id)
+        .annotate(copies_modified=_latest_of(ActualBook.objects.filter(abstract_book=OuterRef('pk'))),
+            authors_modified=_latest_of(Author.objects.filter(abstractbook=OuterRef('pk'))),
+            related_computed=_latest_of(related, 'computed'),
+            related_modified=_latest_of(related, 'related__modified'))
+        .values_list('modified', 'copies_modified', 'authors_modified', 'related_computed', 'related_modified').first())
+    if row is None:
+        return None
+    return _latest(*row), [get_version('abstractbook', book_id)]
+
+
+def author_state(author_id):
+    """ The author page shows the author and the titles of their books. None if the author does not exist """
+    row = (Author.objects.filter(id=author_id)
+        .annotate(books_modified=_latest_of(AbstractBook.objects.filter(author=OuterRef('pk'))))
+        .values_list('modified', 'books_modified').first())
+    if row is None:
+        return None
+    return _latest(*row), [get_version('author', author_id)]
+
+
+def conditional_catalogue_page(state_function):
+    """ Decorator of the catalogue views. state_function receives the URL parameters of the view and returns
+        (last modified, versions), or None when the view will answer a 404 anyway
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if (request.method not in ('GET', 'HEAD') or request.user.is_authenticated
+                    or len(get_messages(request))):
+                # Personal content: the member's name, a pending notification message...
+                response = view(request, *args, **kwargs)
+                patch_cache_control(response, private=True)
+                return response
+            state = state_function(*args, **kwargs)
+            if state is None or state[0] is None:
+                return view(request, *args, **kwargs)
+            last_modified, versions = state
+            timestamp = int(last_modified.timestamp())
+            etag = '"%s"' % hashlib.md5(('%s:%s:%s' % (request.get_full_path(), last_modified.isoformat(), versions)).encode()).hexdigest()
+            response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+            if response is None:
+                response = view(request, *args, **kwargs)
+            if response.status_code in (200, 304):
+                response['ETag'] = etag
+                response['Last-Modified'] = http_date(timestamp)
+                patch_cache_control(response, public=True, max_age=settings.CATALOGUE_MAX_AGE)
+            # The pages are different for the logged in members
+            patch_vary_headers(response, ['Cookie'])
+            return response
+        return wrapper
+    return decorator
+
+
+# Signal handlers keeping the 'modified' timestamps of the pages up to date.
+# They use update() so that no other save signal is sent.
+
+def _touch(model, ids):
+    ids = [object_id for object_id in ids if object_id is not None]
+    if ids:
+        model.objects.filter(id__in=ids).update(modified=timezone.now())
+
+
+@receiver(post_delete, sender=ActualBook)
+def _copy_deleted(sender, instance, **kwargs):
+    # The other changes of the copies are seen through their own timestamp
+    _touch(AbstractBook, [instance.abstract_book_id])
+
+
+@receiver(pre_delete, sender=AbstractBook)
+@receiver(pre_delete, sender=Author)
+@receiver(pre_delete, sender=Genre)
+def _remember_related(sender, instance, **kwargs):
+    if sender is AbstractBook:
+        instance._touch_author_ids = list(instance.author.values_list('id', flat=True))
+    else:
+        instance._touch_book_ids = list(instance.abstractbook_set.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=AbstractBook)
+def _book_deleted(sender, instance, **kwargs):
+    # The author pages list the titles of their books
+    _touch(Author, getattr(instance, '_touch_author_ids', []))
+
+
+@receiver(post_delete, sender=Author)
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+def _author_deleted_or_genre_changed(sender, instance, created=False, **kwargs):
+    # The book pages show the genres, and the authors (whose changes are seen through their own timestamp)
+    if created:
+        return
+    book_ids = getattr(instance, '_touch_book_ids', None)
+    if book_ids is None:
+        book_ids = instance.abstractbook_set.values_list('id', flat=True)
+    _touch(AbstractBook, list(book_ids))
+
+
+@receiver(m2m_changed, sender=AbstractBook.author.through)
+@receiver(m2m_changed, sender=AbstractBook.genre.through)
+def _book_relations_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        if reverse:
+            instance._touch_cleared_ids = list(instance.abstractbook_set.values_list('id', flat=True))
+        elif sender is AbstractBook.author.through:
+            instance._touch_cleared_ids = list(instance.author.values_list('id', flat=True))
+        else:
+            instance._touch_cleared_ids = []
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    related_ids = getattr(instance, '_touch_cleared_ids', []) if action == 'post_clear' else list(pk_set or [])
+    if reverse:
+        book_ids, other_ids = related_ids, [instance.pk]
+    else:
+        book_ids, other_ids = [instance.pk], related_ids
+    _touch(AbstractBook, book_ids)
+    if sender is AbstractBook.author.through:
+        _touch(Author, other_ids)
@@ -0,0 +1,9 @@
+from .unread import get_unread_count
+
+
+def unread_messages(request):
+    """ Adds the number of unread messages of the logged user to the context of all the templates """
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return {'unread_message_count': 0}
+    return {'unread_message_count': get_unread_count(user.id)}
@@ -1,6 +1,6 @@
 from django import forms
 from django.contrib.auth.forms import UserCreationForm
-from bookHandler.models import User, Transaction
+from bookHandler.models import User, Transaction, AbstractBook
 
 class UserBookForm(forms.Form):
     """ this class will be used to edit an actual book in a user-convenient way.
@@ -13,6 +13,10 @@ class UserBookForm(forms.Form):
     genre = forms.CharField(max_length=100, required=False)
     summary = forms.CharField(required=False, widget=forms.Textarea)
 
+    def clean_isbn(self):
+        """ Checks the ISBN and converts it to its ISBN-13 form """
+        return AbstractBook.normalize_isbn(self.cleaned_data['isbn']) or ''
+
 class RegisterForm(UserCreationForm):
     """ Extends the basic User Creation Form with supplementary fields """
     first_name = forms.CharField(max_length=30,required=False)
@@ -50,6 +54,10 @@ class EditTransactionForm(forms.ModelForm):
         for field in iter(self.fields):
             if self.fields[field].widget.__class__.__name__ in ('AdminTextInputWidget' , 'Textarea' ,'TextInput', 'NumberInput' , 'AdminURLFieldWidget', 'Select'):
                 self.fields[field].widget.attrs.update({ 'class': 'form-control' })
+        if self.instance.pk:
+            # Only offering the states allowed after the current one
+            allowed_states = self.instance.allowed_states()
+            self.fields['transaction_state'].choices = [(state, label) for (state, label) in Transaction.TRANSACTION_STATUS if state in allowed_states]
 
 class NewMessageForm(forms.Form):
 
@@ -0,0 +1,147 @@
+""" Versioned keys for the template fragment cache.
+
+Each cached object (abstract book, author, actual book, plus a global 'catalogue' counter for the listing pages) has a
+version number stored in the cache. The templates put that version in the key of their {% cache %} fragments, and the
+signal handlers below bump it whenever something displayed in the fragment changes. Old fragments are never read
+again and simply expire.
+
+A version is bumped in the cache of the process making the change, so the other processes only see it through a cache
+shared by all of them (CACHE_SHARED setting). With the default per-process caches, the versions, and the fragments,
+index pages and validators (conditional.py) depending on them, expire after LOCAL_CACHE_TIMEOUT seconds instead, which
+bounds how long another process serves an outdated page.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+
+from .models import AbstractBook, ActualBook, Author, Genre
+
+LOCAL_CACHE_TIMEOUT = 60
+SHARED_CACHE = bool(getattr(settings, 'CACHE_SHARED', ''))
+
+# How long a version is kept: until evicted when the versions are shared
+VERSION_TIMEOUT = None if SHARED_CACHE else LOCAL_CACHE_TIMEOUT
+# How long a rendered fragment is kept. With a shared cache, invalidation does not rely on it, it only limits the
+# memory used.
+FRAGMENT_CACHE_TIMEOUT = 60*60*24 if SHARED_CACHE else LOCAL_CACHE_TIMEOUT
+
+CATALOGUE = 'catalogue'
+
+
+def _version_key(label, object_id=None):
+    return 'version:%s:%s' % (label, object_id)
+
+
+def _label(obj):
+    return obj._meta.model_name
+
+
+def get_version(label, object_id=None):
+    """ Returns the current version of an object (label is the model name, e.g. 'abstractbook') """
+    key = _version_key(label, object_id)
+    version = cache.get(key)
+    if version is None:
+        # Starting from the current time (instead of 1) so that a counter evicted from the cache never
+        # comes back to a version number used before
+        version = int(time.time() * 1000)
+        if not cache.add(key, version, VERSION_TIMEOUT):
+            version = cache.get(key, version)
+    return version
+
+
+def bump_version(label, object_ids=(None,)):
+    for object_id in object_ids:
+        try:
+            cache.incr(_version_key(label, object_id))
+        except ValueError:
+            # Not in the cache: nothing was cached with the current version
+            pass
+
+
+def get_object_version(obj):
+    return get_version(_label(obj), obj.pk)
+
+
+def _book_author_ids(book_ids):
+    return set(AbstractBook.author.through.objects.filter(abstractbook__in=book_ids).values_list('author_id', flat=True))
+
+
+def bump_book_versions(book_ids, author_ids=None):
+    """ Bumps the versions of the given abstract books, of their authors (whose pages list their titles) and of the
+        catalogue. Called by the signal handlers, and by the commands writing the books with bulk_create() or update(),
+        which send no signal.
+    """
+    bump_version('abstractbook', book_ids)
+    if author_ids is None:
+        author_ids = _book_author_ids(book_ids)
+    bump_version('author', author_ids)
+    bump_version(CATALOGUE)
+
+
+# Signal handlers
+
+
+@receiver(pre_delete, sender=AbstractBook)
+@receiver(pre_delete, sender=Author)
+@receiver(pre_delete, sender=Genre)
+def _remember_related(sender, instance, **kwargs):
+    if sender is AbstractBook:
+        instance._cache_author_ids = _book_author_ids([instance.pk])
+    else:
+        instance._cache_book_ids = set(instance.abstractbook_set.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=AbstractBook)
+@receiver(post_delete, sender=AbstractBook)
+def _abstract_book_changed(sender, instance, **kwargs):
+    bump_book_versions([instance.pk], getattr(instance, '_cache_author_ids', None))
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_delete, sender=Author)
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+def _author_or_genre_changed(sender, instance, created=False, **kwargs):
+    if created:
+        return
+    if sender is Author:
+        bump_version('author', [instance.pk])
+        bump_version(CATALOGUE)
+    book_ids = getattr(instance, '_cache_book_ids', None)
+    if book_ids is None:
+        book_ids = instance.abstractbook_set.values_list('id', flat=True)
+    bump_version('abstractbook', book_ids)
+
+
+@receiver(m2m_changed, sender=AbstractBook.author.through)
+@receiver(m2m_changed, sender=AbstractBook.genre.through)
+def _book_relations_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # The related objects won't be known anymore after the clear
+        if reverse:
+            instance._cache_cleared_ids = set(instance.abstractbook_set.values_list('id', flat=True))
+        elif sender is AbstractBook.author.through:
+            instance._cache_cleared_ids = set(instance.author.values_list('id', flat=True))
+        else:
+            instance._cache_cleared_ids = set()
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    related_ids = getattr(instance, '_cache_cleared_ids', set()) if action == 'post_clear' else pk_set or set()
+    if reverse:
+        book_ids, other_ids = related_ids, [instance.pk]
+    else:
+        book_ids, other_ids = [instance.pk], related_ids
+    bump_version('abstractbook', book_ids)
+    if sender is AbstractBook.author.through:
+        bump_version('author', other_ids)
+        bump_version(CATALOGUE)
+
+
+@receiver(post_save, sender=ActualBook)
+@receiver(post_delete, sender=ActualBook)
+def _actual_book_changed(sender, instance, **kwargs):
+    bump_version('actualbook', [instance.pk])
@@ -0,0 +1,243 @@
+""" Background jobs, stored in the Job table and run by the 'run_worker' management command.
+
+A view calls enqueue('task name', **kwargs) instead of doing slow work (sending e-mails, rebuilding caches) while the
+member waits. The job row is written in the same database transaction as the rest of the request, so a job is never
+run for a change which was rolled back.
+
+Workers claim a job with a conditional UPDATE (status queued -> running), so several worker processes can share the
+same table without running a job twice. A job raising an exception is retried with an exponential delay, up to its
+max_attempts, then left in the failed state with its error message.
+"""
+import json
+import logging
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import send_mail, mail_admins
+from django.db.models import F, Count
+from django.utils import timezone
+
+from .models import Job, Transaction, AbstractBook, SearchToken
+from .reminders import scan_due_transactions, format_report
+
+logger = logging.getLogger(__name__)
+
+# Delay before the first retry of a failed job, doubled at each attempt
+RETRY_DELAY = timedelta(seconds=30)
+# A job still running after this delay is considered lost (e.g. the worker was killed) and is queued again. It must be
+# longer than the slowest run of the task, which can be given to the task decorator
+STALE_JOB_TIMEOUT = timedelta(seconds=getattr(settings, 'JOB_STALE_TIMEOUT', 60*60))
+# Number of finished jobs used to compute the queue latency
+LATENCY_WINDOW = 1000
+
+TASKS = {}
+# Tasks queued again automatically after each run: name -> interval
+PERIODIC_TASKS = {}
+# Tasks whose runs can last longer than STALE_JOB_TIMEOUT: name -> timeout
+TASK_TIMEOUTS = {}
+
+
+def task(name, every=None, timeout=None):
+    """ Decorator registering a function as a task which can be enqueued by name """
+    def register(function):
+        TASKS[name] = function
+        if every is not None:
+            PERIODIC_TASKS[name] = every
+        if timeout is not None:
+            TASK_TIMEOUTS[name] = timeout
+        return function
+    return register
+
+
+def enqueue(name, run_after=None, max_attempts=3, **kwargs):
+    """ Adds a job to the queue. The keyword arguments are passed to the task and must be JSON serialisable """
+    if name not in TASKS:
+        raise ValueError('Unknown task "%s"' % name)
+    return Job.objects.create(name=name, payload=json.dumps(kwargs, sort_keys=True), max_attempts=max_attempts,
+        run_after=run_after or timezone.now())
+
+
+def enqueue_once(name, run_after=None, **kwargs):
+    """ Same as enqueue, unless the same job is already waiting in the queue (e.g. a cache rebuild requested twice) """
+    payload = json.dumps(kwargs, sort_keys=True)
+    job = Job.objects.filter(name=name, payload=payload, status=Job.QUEUED).first()
+    if job is not None:
+        return job
+    return enqueue(name, run_after=run_after, **kwargs)
+
+
+def retry_delay(attempts):
+    return RETRY_DELAY * 2**(attempts-1)
+
+
+def claim_next_job():
+    """ Marks the next runnable job as running and returns it, or None if the queue is empty """
+    while True:
+        now = timezone.now()
+        job_id = (Job.objects.filter(status=Job.QUEUED, run_after__lte=now).order_by('run_after', 'id')
+            .values_list('id', flat=True).first())
+        if job_id is None:
+            return None
+        # Only one worker can win this update, the others try the next job
+        if Job.objects.filter(id=job_id, status=Job.QUEUED).update(status=Job.RUNNING, started=now, attempts=F('attempts')+1):
+            return Job.objects.get(id=job_id)
+
+
+def run_job(job):
+    """ Runs a claimed job and records its result. Returns True if the task succeeded """
+    try:
+        TASKS[job.name](**json.loads(job.payload))
+    except Exception:
+        job.last_error = traceback.format_exc()
+        if job.attempts < job.max_attempts:
+            job.status = Job.QUEUED
+            job.run_after = timezone.now() + retry_delay(job.attempts)
+            job.save(update_fields=['status', 'run_after', 'last_error'])
+            logger.warning('Job %s (%s) failed, retry %d/%d at %s', job.id, job.name, job.attempts, job.max_attempts-1, job.run_after)
+            return False
+        job.status = Job.FAILED
+        job.finished = timezone.now()
+        job.save(update_fields=['status', 'finished', 'last_error'])
+        logger.error('Job %s (%s) failed after %d attempts', job.id, job.name, job.attempts)
+        succeeded = False
+    else:
+        job.status = Job.DONE
+        job.finished = timezone.now()
+        job.save(update_fields=['status', 'finished'])
+        succeeded = True
+    if job.name in PERIODIC_TASKS:
+        enqueue_once(job.name, run_after=job.started + PERIODIC_TASKS[job.name])
+    return succeeded
+
+
+def run_pending(limit=None):
+    """ Runs the runnable jobs one after the other until the queue is empty. Returns the number of jobs run """
+    nr_jobs = 0
+    while limit is None or nr_jobs < limit:
+        job = claim_next_job()
+        if job is None:
+            break
+        run_job(job)
+        nr_jobs += 1
+    return nr_jobs
+
+
+def requeue_stale_jobs():
+    """ Queues again the jobs whose worker died while running them, with the same retry delay and limit as a failed
+        job (the lost run was counted in the attempts when the job was claimed). Returns the number of jobs requeued
+    """
+    now = timezone.now()
+    shortest_timeout = min([STALE_JOB_TIMEOUT] + list(TASK_TIMEOUTS.values()))
+    nr_requeued = 0
+    for job in Job.objects.filter(status=Job.RUNNING, started__lt=now-shortest_timeout):
+        if job.started >= now - TASK_TIMEOUTS.get(job.name, STALE_JOB_TIMEOUT):
+            continue
+        # Conditional update, in case the job finishes in the meantime
+        running = Job.objects.filter(id=job.id, status=Job.RUNNING, started=job.started)
+        last_error = 'Worker lost after %s' % (now - job.started)
+        if job.attempts < job.max_attempts:
+            nr_requeued += running.update(status=Job.QUEUED, run_after=now + retry_delay(job.attempts), last_error=last_error)
+            logger.warning('Job %s (%s) lost, retry %d/%d', job.id, job.name, job.attempts, job.max_attempts-1)
+        elif running.update(status=Job.FAILED, finished=now, last_error=last_error):
+            logger.error('Job %s (%s) lost after %d attempts', job.id, job.name, job.attempts)
+            if job.name in PERIODIC_TASKS:
+                enqueue_once(job.name, run_after=job.started + PERIODIC_TASKS[job.name])
+    return nr_requeued
+
+
+def schedule_periodic_tasks():
+    for name in PERIODIC_TASKS:
+        if not Job.objects.filter(name=name, status__in=[Job.QUEUED, Job.RUNNING]).exists():
+            enqueue(name)
+
+
+def _percentile(sorted_values, ratio):
+    return sorted_values[min(len(sorted_values)-1, int(len(sorted_values) * ratio))]
+
+
+def queue_stats():
+    """ Number of jobs per status, and the queue latency (time between a job becoming runnable and a worker
+        starting it) of the last LATENCY_WINDOW jobs started, in seconds
+    """
+    counts = {label: 0 for (status, label) in Job.JOB_STATUS}
+    for row in Job.objects.values('status').annotate(nr=Count('id')).order_by():
+        counts[dict(Job.JOB_STATUS)[row['status']]] = row['nr']
+    started = (Job.objects.filter(status__in=[Job.DONE, Job.FAILED]).exclude(started=None)
+        .order_by('-started').values_list('run_after', 'started')[:LATENCY_WINDOW])
+    latencies = sorted(max(0, (start - run_after).total_seconds()) for (run_after, start) in started)
+    stats = {'counts': counts, 'nr_measured': len(latencies), 'runnable': Job.objects.filter(status=Job.QUEUED, run_after__lte=timezone.now()).count()}
+    if latencies:
+        stats.update({
+            'avg_latency': sum(latencies) / len(latencies),
+            'p50_latency': _percentile(latencies, 0.5),
+            'p95_latency': _percentile(latencies, 0.95),
+            'max_latency': latencies[-1],
+        })
+    return stats
+
+
+# Tasks
+
+@task('notify_new_request')
+def notify_new_request(transaction_id):
+    """ E-mail to the owner of a book which a member would like to borrow """
+    book_transaction = Transaction.objects.select_related('lender', 'borrower', 'book__abstract_book').get(id=transaction_id)
+    lender = book_transaction.lender
+    if not lender.email:
+        return
+    send_mail('[Niseko Book Club] New borrowing request for "%s"' % book_transaction.book.abstract_book.title,
+        'Hello %s,\n\n%s would like to borrow your copy of "%s".\nYou can accept or reject the request from the '
+        '"My books" page of the Niseko Book Club.\n' % (lender.username, book_transaction.borrower.username,
+            book_transaction.book.abstract_book.title),
+        settings.DEFAULT_FROM_EMAIL, [lender.email])
+
+
+@task('scan_due_transactions', every=timedelta(days=1))
+def send_due_back_messages():
+    """ Once a day, reminder messages (and e-mails for the overdue books) for the books due back soon or overdue.
+        The report goes to the ADMINS
+    """
+    report = format_report(scan_due_transactions())
+    logger.info(report)
+    mail_admins('Due back report', report)
+
+
+@task('warm_book_index')
+def warm_book_index():
+    """ Computes the first page of the book index into the cache, so that the first visitor after a change of the
+        catalogue does not pay for it. Only useful with a cache shared with the web processes (CACHE_SHARED setting)
+    """
+    from .views import _book_index_cache_key, _book_index_page
+    from .fragment_cache import FRAGMENT_CACHE_TIMEOUT
+    from .conditional import book_index_state
+    cache.set(_book_index_cache_key('', ''), _book_index_page('', ''), FRAGMENT_CACHE_TIMEOUT)
+    book_index_state()
+
+
+@task('compute_trending_books', every=timedelta(hours=1))
+def compute_trending_books():
+    """ Every hour, the trending books shown on the home page and by the API """
+    from .trending import compute_trending_books
+    compute_trending_books()
+
+
+@task('refresh_related_books', every=timedelta(hours=1), timeout=timedelta(hours=6))
+def refresh_related_books(full=False):
+    """ Every hour, the 'members who borrowed this also borrowed' lists of the books borrowed in the meantime """
+    from .recommendations import refresh_related_books
+    report = refresh_related_books(full=full)
+    logger.info('Related books of %(books)d books computed (%(rows)d rows, %(engine)s, %(duration).2f s)', report)
+
+
+@task('rebuild_search_index', timeout=timedelta(hours=6))
+def rebuild_search_index(chunk_size=500):
+    """ Rebuilds from scratch the search index of all the abstract books (also run by the rebuild_search_index
+        command)
+    """
+    from .search import index_books
+    SearchToken.objects.all().delete()
+    book_ids = list(AbstractBook.objects.order_by('id').values_list('id', flat=True))
+    for start in range(0, len(book_ids), chunk_size):
+        index_books(book_ids[start:start+chunk_size])
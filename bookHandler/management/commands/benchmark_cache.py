@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from bookHandler.benchmark import make_client, time_url, format_results
+from bookHandler.models import AbstractBook, Author, User
+
+NO_CACHE = {
+    'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+}
+
+
+class Command(BaseCommand):
+    help = """Compares the latency of the main pages without any cache (database sessions, dummy cache) and with the
+        cache configured in the settings. Uses the current database, so it should be run on a copy of production data."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Username used for the pages needing a login (default: first user)')
+        parser.add_argument('--repeat', type=int, default=20, help='Number of requests per page')
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options['user']).first() if options['user'] else User.objects.order_by('id').first()
+        if user is None:
+            raise CommandError('A user is needed to time the pages behind the login')
+        book = AbstractBook.objects.order_by('id').first()
+        author = Author.objects.order_by('id').first()
+        urls = ['/bookhandler/', '/bookhandler/my_books', '/bookhandler/user_profile']
+        if book:
+            urls.append(book.get_absolute_url())
+        if author:
+            urls.append(author.get_absolute_url())
+
+        configurations = [
+            ('Without cache', {'CACHES': NO_CACHE, 'SESSION_ENGINE': 'django.contrib.sessions.backends.db'}),
+            ('With the configured cache (%s)' % settings.CACHES['default']['BACKEND'], {}),
+        ]
+        for name, overrides in configurations:
+            with override_settings(**overrides):
+                client = make_client(user)
+                results = [time_url(client, url, options['repeat']) for url in urls]
+            self.stdout.write(name)
+            self.stdout.write(format_results(results) + '\n')
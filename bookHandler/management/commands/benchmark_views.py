@@ -0,0 +1,72 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from bookHandler.benchmark import make_client, time_url, format_results
+from bookHandler.models import AbstractBook, Message, Transaction, User
+
+
+class Command(BaseCommand):
+    help = """Times the main views on the current database (see seed_database) and reports their latency and number of
+        queries. With --baseline, fails if a view got slower than the baseline by more than --tolerance, or runs more
+        queries, so that it can be used before a deploy."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20, help='Number of requests per view')
+        parser.add_argument('--output', help='Writes the results to this JSON file (e.g. to be used later as a baseline)')
+        parser.add_argument('--baseline', help='JSON file written by a previous run with --output')
+        parser.add_argument('--tolerance', type=float, default=1.5, help='Allowed ratio between the median latency and the baseline')
+
+    def handle(self, *args, **options):
+        targets = self.pick_targets()
+        results = []
+        for (name, user, url) in targets:
+            client = make_client(user)
+            result = time_url(client, url, options['repeat'])
+            result['view'] = name
+            results.append(result)
+        self.stdout.write(format_results(results))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = {result['view']: result for result in json.load(f)}
+            regressions = []
+            for result in results:
+                reference = baseline.get(result['view'])
+                if reference is None:
+                    continue
+                if result['queries'] > reference['queries']:
+                    regressions.append('%s: %d queries instead of %d' % (result['view'], result['queries'], reference['queries']))
+                if result['median_ms'] > reference['median_ms'] * options['tolerance']:
+                    regressions.append('%s: median %.2f ms instead of %.2f ms' % (result['view'], result['median_ms'], reference['median_ms']))
+            if regressions:
+                raise CommandError('Performance regressions:\n' + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regression compared to %s' % options['baseline']))
+
+    def pick_targets(self):
+        """ Returns a list of (view name, user, url), using the heaviest objects of the database for each view """
+        lender = User.objects.annotate(nr_books=Count('book_inventory')).order_by('-nr_books').first()
+        borrower = (Transaction.objects.filter(transaction_state__in=Transaction.ACTIVE_TRANSACTION)
+            .values('borrower').annotate(nr=Count('id')).order_by('-nr').first())
+        book = AbstractBook.objects.annotate(nr_copies=Count('instances')).order_by('-nr_copies').first()
+        conversation = Message.objects.values('transaction').annotate(nr=Count('id')).order_by('-nr').first()
+        if lender is None or book is None:
+            raise CommandError('The database is empty, see the seed_database command')
+
+        targets = [
+            ('book_index', None, '/bookhandler/'),
+            ('abstract_detailed_view', None, book.get_absolute_url()),
+            ('my_books_view', lender, '/bookhandler/my_books'),
+            ('profile_view', lender, '/bookhandler/user_profile'),
+        ]
+        if borrower:
+            targets.append(('my_requests_view', User.objects.get(id=borrower['borrower']), '/bookhandler/my_requests'))
+        if conversation:
+            book_transaction = Transaction.objects.select_related('lender').get(id=conversation['transaction'])
+            targets.append(('view_conversation', book_transaction.lender, '/bookhandler/view_conversation/%s' % book_transaction.id))
+        return targets
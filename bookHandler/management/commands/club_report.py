@@ -0,0 +1,38 @@
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from bookHandler.reports import get_report, format_report, write_csv, month_start, previous_months, REPORT_SETTLING_DAYS
+
+
+class Command(BaseCommand):
+    help = """Prints the monthly statistics of the club: books lent per area and per genre, average loan length and
+        loss rate (see bookHandler/reports.py). The reports of the months which ended more than %d days ago are
+        stored the first time they are computed.""" % REPORT_SETTLING_DAYS
+
+    def add_arguments(self, parser):
+        parser.add_argument('--month', help='Last month of the report (YYYY-MM), the previous month by default')
+        parser.add_argument('--months', type=int, default=1, help='Number of months, ending with --month')
+        parser.add_argument('--csv', help='Writes the reports to this CSV file ("-" for the standard output) instead of printing them')
+
+    def handle(self, *args, **options):
+        today = timezone.localdate()
+        if options['month']:
+            try:
+                last_month = datetime.strptime(options['month'], '%Y-%m').date()
+            except ValueError:
+                raise CommandError('Invalid month "%s", the format is YYYY-MM' % options['month'])
+        else:
+            last_month = month_start(month_start(today) - timedelta(days=1))
+        if options['months'] < 1:
+            raise CommandError('--months must be at least 1')
+        reports = [get_report(month, today) for month in previous_months(last_month, options['months'])]
+        if options['csv'] == '-':
+            write_csv(reports, self.stdout)
+        elif options['csv']:
+            with open(options['csv'], 'w', newline='') as f:
+                write_csv(reports, f)
+            self.stdout.write(self.style.SUCCESS('%d monthly reports written to %s' % (len(reports), options['csv'])))
+        else:
+            self.stdout.write('\n\n'.join(format_report(report) for report in reports))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from bookHandler.recommendations import refresh_related_books
+
+
+class Command(BaseCommand):
+    help = """Computes the 'members who borrowed this also borrowed' lists of the books (see bookHandler/recommendations.py).
+        Only the books borrowed since the last computation are done, unless --full is given"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Recomputes the lists of all the books')
+
+    def handle(self, *args, **options):
+        report = refresh_related_books(full=options['full'])
+        self.stdout.write(self.style.SUCCESS('%s computation (%s): %d borrows, related books of %d books, %d rows, %.2f s' % (
+            'Full' if report['full'] else 'Incremental', report['engine'], report['borrows'], report['books'],
+            report['rows'], report['duration'])))
@@ -0,0 +1,41 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from bookHandler.models import Author
+
+
+class Command(BaseCommand):
+    help = 'Fills the normalised name key of all the authors, merging the authors which end up with the same key'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only reports the duplicates, without changing anything')
+
+    def handle(self, *args, **options):
+        authors_by_key = defaultdict(list)
+        for author in Author.objects.order_by('id').only('id', 'first_name', 'last_name', 'bio', 'name_key').iterator():
+            key = Author.normalize_name('%s %s' % (author.last_name, author.first_name))
+            authors_by_key[key].append(author)
+
+        nr_merged = 0
+        with transaction.atomic():
+            for key, authors in authors_by_key.items():
+                keeper, duplicates = authors[0], authors[1:]
+                for duplicate in duplicates:
+                    self.stdout.write('Merging "%s" (%d) into "%s" (%d)' % (duplicate, duplicate.id, keeper, keeper.id))
+                    if options['dry_run']:
+                        continue
+                    keeper.abstractbook_set.add(*duplicate.abstractbook_set.all())
+                    if not keeper.bio and duplicate.bio:
+                        Author.objects.filter(id=keeper.id).update(bio=duplicate.bio, modified=timezone.now())
+                    duplicate.delete()
+                nr_merged += len(duplicates)
+            if not options['dry_run']:
+                # The duplicates are gone so the keys can be written without breaking the unique index
+                for key, authors in authors_by_key.items():
+                    if authors[0].name_key != key:
+                        Author.objects.filter(id=authors[0].id).update(name_key=key)
+
+        self.stdout.write(self.style.SUCCESS('%d authors, %d duplicates merged' % (len(authors_by_key), nr_merged)))
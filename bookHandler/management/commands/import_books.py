@@ -0,0 +1,225 @@
+import csv
+import json
+import os
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models.functions import Lower
+
+from bookHandler.fragment_cache import bump_book_versions
+from bookHandler.models import AbstractBook, ActualBook, Author, Genre, User
+from bookHandler.search import index_books
+
+
+class Command(BaseCommand):
+    help = """Imports a list of books from a CSV file (with a header line) or a JSONL file (one JSON object per line).
+        Recognised fields: title, author (several authors separated by commas, last name first), isbn, genre
+        (separated by commas), summary and owner (username of the owner of the physical copy)."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV or JSONL file to import')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='File format, guessed from the extension if not given')
+        parser.add_argument('--owner', help='Username owning the imported copies, when the file has no owner column')
+        parser.add_argument('--catalogue-only', action='store_true', help='Only creates the abstract books, not the physical copies')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Number of rows written per transaction')
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or ('jsonl' if os.path.splitext(options['path'])[1].lower() in ('.jsonl', '.json') else 'csv')
+        self.catalogue_only = options['catalogue_only']
+        self.default_owner = None
+        if options['owner']:
+            try:
+                self.default_owner = User.objects.get(username=options['owner'])
+            except User.DoesNotExist:
+                raise CommandError('Unknown user "%s"' % options['owner'])
+
+        # Memoisation of what was already resolved, shared by all the chunks
+        self.authors = {}   # name key -> Author
+        self.genres = {}    # lower case name -> Genre
+        self.books = {}     # ('isbn', isbn13) or ('title', title, author ids) -> AbstractBook
+        self.titles = {}    # title -> [(AbstractBook, author ids)], the books a row can match by title
+        self.owners = {}    # username -> User
+        self.nr_rows = self.nr_new_books = self.nr_copies = self.nr_errors = 0
+
+        with open(options['path'], newline='', encoding='utf-8') as f:
+            rows = csv.DictReader(f) if file_format == 'csv' else (json.loads(line) for line in f if line.strip())
+            while True:
+                chunk = list(islice(rows, options['chunk_size']))
+                if not chunk:
+                    break
+                with transaction.atomic():
+                    book_ids = self.import_chunk(chunk)
+                # bulk_create and update() do not send the signals invalidating the cached pages. After the commit, so
+                # that the pages rendered again show the new rows
+                bump_book_versions(book_ids)
+                self.stdout.write('%d rows imported' % self.nr_rows)
+
+        self.stdout.write(self.style.SUCCESS('%d rows: %d new books, %d copies, %d rows skipped' % (self.nr_rows, self.nr_new_books, self.nr_copies, self.nr_errors)))
+
+    def import_chunk(self, chunk):
+        """ Imports the rows of the chunk and returns the ids of the abstract books created or given copies """
+        entries = []
+        for row in chunk:
+            self.nr_rows += 1
+            entry = self.parse_row(row)
+            if entry is not None:
+                entries.append(entry)
+
+        self.resolve_authors({name for entry in entries for name in entry['authors']})
+        self.resolve_genres({name for entry in entries for name in entry['genres']})
+        self.resolve_owners({entry['owner'] for entry in entries if entry['owner']})
+        new_books = self.resolve_books(entries)
+        book_ids = {book.id for book in new_books}
+
+        if not self.catalogue_only:
+            copies = []
+            for entry in entries:
+                owner = self.owners.get(entry['owner']) if entry['owner'] else self.default_owner
+                if owner is None:
+                    self.nr_errors += 1
+                    self.stderr.write('Row %d: no owner for "%s", copy not created' % (entry['line'], entry['title']))
+                    continue
+                copies.append(ActualBook(abstract_book=entry['book'], owner=owner))
+            ActualBook.objects.bulk_create(copies)
+            self.nr_copies += len(copies)
+            # bulk_create does not go through ActualBook.save, which maintains the copy counters of the books
+            copy_book_ids = {copy.abstract_book_id for copy in copies}
+            AbstractBook.recount(AbstractBook.objects.filter(id__in=copy_book_ids))
+            book_ids |= copy_book_ids
+        # bulk_create does not send the signals keeping the search index up to date
+        index_books([book.id for book in new_books])
+        return book_ids
+
+    def parse_row(self, row):
+        title = (row.get('title') or '').strip()
+        authors = [name.strip() for name in (row.get('author') or '').split(',') if name.strip()]
+        if not title or not authors:
+            self.nr_errors += 1
+            self.stderr.write('Row %d: a title and at least one author are required' % self.nr_rows)
+            return None
+        try:
+            isbn13 = AbstractBook.normalize_isbn(row.get('isbn') or '')
+        except ValidationError as e:
+            self.stderr.write('Row %d: %s, ISBN ignored' % (self.nr_rows, e.messages[0]))
+            isbn13 = None
+        return {
+            'line': self.nr_rows,
+            'title': title,
+            'authors': authors,
+            'isbn13': isbn13,
+            'genres': [name.strip() for name in (row.get('genre') or '').split(',') if name.strip()],
+            'summary': (row.get('summary') or '').strip(),
+            'owner': (row.get('owner') or '').strip(),
+        }
+
+    def resolve_authors(self, names):
+        keys = {}
+        for name in names:
+            keys.setdefault(Author.normalize_name(name), name)
+        missing = [key for key in keys if key not in self.authors]
+        for author in Author.objects.filter(name_key__in=missing):
+            self.authors[author.name_key] = author
+        new_authors = []
+        for key in missing:
+            if key not in self.authors:
+                # Same LAST NAME FIRST convention as Author.get_or_create
+                last_name, first_name = Author.split_name(keys[key])
+                author = Author(last_name=last_name, first_name=first_name, name_key=key)
+                new_authors.append(author)
+                self.authors[key] = author
+        self._bulk_create_with_ids(Author, new_authors, ['name_key'])
+
+    def resolve_genres(self, names):
+        missing = {name.lower(): name for name in names if name.lower() not in self.genres}
+        for genre in Genre.objects.annotate(lower_name=Lower('name')).filter(lower_name__in=list(missing)).order_by('id'):
+            self.genres.setdefault(genre.name.lower(), genre)
+        new_genres = []
+        for lower_name, name in missing.items():
+            if lower_name not in self.genres:
+                genre = Genre(name=name)
+                new_genres.append(genre)
+                self.genres[lower_name] = genre
+        self._bulk_create_with_ids(Genre, new_genres, ['name'])
+
+    def resolve_owners(self, usernames):
+        missing = [username for username in usernames if username not in self.owners]
+        for user in User.objects.filter(username__in=missing):
+            self.owners[user.username] = user
+
+    def resolve_books(self, entries):
+        """ Sets entry['book'] for all the entries, creating the missing abstract books. Returns the new books.
+            Same matching as AbstractBook.get_or_create: by ISBN first, then by title among the books having all the
+            authors of the row (only the books without ISBN for a row with an ISBN, which then gets the ISBN)
+        """
+        for entry in entries:
+            entry['author_ids'] = frozenset(self.authors[Author.normalize_name(name)].id for name in entry['authors'])
+            entry['key'] = ('isbn', entry['isbn13']) if entry['isbn13'] else ('title', entry['title'], entry['author_ids'])
+
+        isbns = [entry['isbn13'] for entry in entries if entry['isbn13'] and entry['key'] not in self.books]
+        for book in AbstractBook.objects.filter(isbn13__in=isbns):
+            self.books[('isbn', book.isbn13)] = book
+        titles = {entry['title'] for entry in entries if entry['key'] not in self.books and entry['title'] not in self.titles}
+        for title in titles:
+            self.titles[title] = []
+        for book in AbstractBook.objects.filter(title__in=titles).order_by('id').prefetch_related('author'):
+            self.titles[book.title].append((book, frozenset(author.id for author in book.author.all())))
+
+        new_books = []
+        new_entries = []
+        for entry in entries:
+            if entry['key'] not in self.books:
+                book = self.match_title(entry)
+                if book is None:
+                    book = AbstractBook(title=entry['title'], summary=entry['summary'], isbn=entry['isbn13'] or '', isbn13=entry['isbn13'])
+                    self.titles[entry['title']].append((book, entry['author_ids']))
+                    new_books.append(book)
+                    new_entries.append(entry)
+                elif entry['isbn13']:
+                    # The book gets the ISBN, and is not matched by the rows with another ISBN anymore
+                    book.isbn = book.isbn13 = entry['isbn13']
+                    if book.pk is not None:
+                        book.save()
+                self.books[entry['key']] = book
+            entry['book'] = self.books[entry['key']]
+        self._bulk_create_with_ids(AbstractBook, new_books, ['title', 'isbn13', 'summary'])
+
+        author_links = []
+        genre_links = []
+        for entry in new_entries:
+            book = entry['book']
+            for author_id in entry['author_ids']:
+                author_links.append(AbstractBook.author.through(abstractbook_id=book.id, author_id=author_id))
+            for genre_id in {self.genres[name.lower()].id for name in entry['genres']}:
+                genre_links.append(AbstractBook.genre.through(abstractbook_id=book.id, genre_id=genre_id))
+        AbstractBook.author.through.objects.bulk_create(author_links)
+        AbstractBook.genre.through.objects.bulk_create(genre_links)
+        self.nr_new_books += len(new_books)
+        return new_books
+
+    def match_title(self, entry):
+        for (book, author_ids) in self.titles[entry['title']]:
+            if entry['author_ids'] <= author_ids and not (entry['isbn13'] and book.isbn13):
+                return book
+        return None
+
+    @staticmethod
+    def _bulk_create_with_ids(model, objects, key_fields):
+        """ bulk_create which also sets the primary keys on backends which don't return them (e.g. SQLite): the new
+            rows are read back by their natural key (key_fields), among the rows after the previous highest id.
+            Objects with the same key get the ids in creation order.
+        """
+        if not objects:
+            return
+        last_id = model.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        model.objects.bulk_create(objects)
+        if objects[0].pk is not None:
+            return
+        new_ids = {}
+        rows = (model.objects.filter(id__gt=last_id, **{'%s__in' % key_fields[0]: {getattr(obj, key_fields[0]) for obj in objects}})
+            .order_by('id').values_list('id', *key_fields))
+        for row in rows:
+            new_ids.setdefault(tuple(row[1:]), []).append(row[0])
+        for obj in objects:
+            obj.pk = new_ids[tuple(getattr(obj, field) for field in key_fields)].pop(0)
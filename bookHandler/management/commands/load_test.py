@@ -0,0 +1,110 @@
+import json
+import random
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+
+from bookHandler.benchmark import make_client
+from bookHandler.models import AbstractBook, Transaction
+
+
+class Command(BaseCommand):
+    help = """Load test of the database configuration: --threads clients browse the catalogue and post messages at the
+        same time for --duration seconds, through the whole Django stack (without the network). Run it with different
+        DATABASE_URL, CONN_MAX_AGE or SQLITE_JOURNAL_MODE values on a database filled by seed_database to compare them,
+        e.g. SQLITE_JOURNAL_MODE=DELETE CONN_MAX_AGE=0 manage.py load_test --output delete.json"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--duration', type=float, default=10, help='Seconds')
+        parser.add_argument('--write-ratio', type=float, default=0.2, help='Part of the requests posting a message')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', help='Writes the results to this JSON file')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        book_ids = list(AbstractBook.objects.order_by('?').values_list('id', flat=True)[:1000])
+        conversations = list(Transaction.objects.exclude(lender=None).select_related('lender').order_by('?')[:200])
+        if not book_ids or not conversations:
+            raise CommandError('The database is empty, see the seed_database command')
+
+        # Logging in before the test, so that the clients only measure the browsing
+        clients = []
+        for i in range(options['threads']):
+            book_transaction = conversations[i % len(conversations)]
+            clients.append((make_client(), make_client(book_transaction.lender), str(book_transaction.id), random.Random(rng.random())))
+        connections.close_all()
+
+        results = []
+        results_lock = threading.Lock()
+        deadline = time.monotonic() + options['duration']
+
+        def run(reader, writer, transaction_id, thread_rng):
+            timings = []
+            while time.monotonic() < deadline:
+                if thread_rng.random() < options['write_ratio']:
+                    kind = 'write message'
+                    request = lambda: writer.post('/bookhandler/api/messages', json.dumps({'transaction': transaction_id,
+                        'text': 'load test'}), content_type='application/json')
+                elif thread_rng.random() < 0.5:
+                    kind = 'book index'
+                    after = thread_rng.choice(book_ids)
+                    request = lambda: reader.get('/bookhandler/', {'after': after})
+                else:
+                    kind = 'book page'
+                    book_id = thread_rng.choice(book_ids)
+                    request = lambda: reader.get('/bookhandler/detail/%d/' % book_id)
+                start = time.perf_counter()
+                try:
+                    succeeded = request().status_code < 400
+                except Exception:
+                    # Typically 'database is locked' when a writer waited longer than the busy timeout
+                    succeeded = False
+                timings.append((kind, (time.perf_counter() - start) * 1000, succeeded))
+            connections.close_all()
+            with results_lock:
+                results.extend(timings)
+
+        threads = [threading.Thread(target=run, args=client) for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        summary = self.summarise(results, options['duration'])
+        self.stdout.write(self.describe_configuration())
+        self.stdout.write('%-15s %8s %7s %8s %10s %10s %10s' % ('requests', 'count', 'errors', 'req/s', 'median ms', 'p95 ms', 'max ms'))
+        for row in summary:
+            self.stdout.write('%-15s %8d %7d %8.1f %10.2f %10.2f %10.2f' % (row['kind'], row['count'], row['errors'],
+                row['throughput'], row['median_ms'], row['p95_ms'], row['max_ms']))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'configuration': self.describe_configuration(), 'results': summary}, f, indent=2)
+
+    @staticmethod
+    def summarise(results, duration):
+        summary = []
+        for kind in sorted({kind for (kind, ms, succeeded) in results}) + ['all']:
+            timings = sorted(ms for (k, ms, succeeded) in results if kind in (k, 'all'))
+            summary.append({
+                'kind': kind,
+                'count': len(timings),
+                'errors': sum(1 for (k, ms, succeeded) in results if kind in (k, 'all') and not succeeded),
+                'throughput': len(timings) / duration,
+                'median_ms': timings[len(timings)//2],
+                'p95_ms': timings[min(len(timings)-1, int(len(timings)*0.95))],
+                'max_ms': timings[-1],
+            })
+        return summary
+
+    @staticmethod
+    def describe_configuration():
+        description = '%s database, CONN_MAX_AGE=%s' % (connection.vendor, connection.settings_dict['CONN_MAX_AGE'])
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode')
+                description += ', journal_mode=%s, busy timeout=%ss' % (cursor.fetchone()[0], connection.settings_dict['OPTIONS'].get('timeout'))
+        connection.close()
+        return description
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from bookHandler.jobs import enqueue_once, rebuild_search_index
+from bookHandler.models import AbstractBook, SearchToken
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds from scratch the search index of all the abstract books'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='Number of books indexed per batch')
+        parser.add_argument('--background', action='store_true', help='Only queues the rebuild, to be run by run_worker')
+
+    def handle(self, *args, **options):
+        if options['background']:
+            job = enqueue_once('rebuild_search_index', chunk_size=options['chunk_size'])
+            self.stdout.write(self.style.SUCCESS('Rebuild queued (job %d)' % job.id))
+            return
+        rebuild_search_index(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS('Indexed %d books (%d tokens)' % (AbstractBook.objects.count(), SearchToken.objects.count())))
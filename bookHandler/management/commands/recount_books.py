@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from bookHandler.models import AbstractBook
+
+
+class Command(BaseCommand):
+    help = """Recomputes the copy, borrow and request counters of the abstract books from the copies and the
+        transactions, e.g. after rows were changed by hand or by bulk operations which bypass the model methods"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only reports the books whose counters are wrong')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Number of books updated per query')
+
+    def handle(self, *args, **options):
+        book_ids = AbstractBook.recount(dry_run=options['dry_run'], chunk_size=options['chunk_size'])
+        if book_ids:
+            self.stdout.write('Wrong counters: %s%s' % (', '.join(str(book_id) for book_id in book_ids[:20]),
+                ' ...' if len(book_ids) > 20 else ''))
+        verb = 'found' if options['dry_run'] else 'fixed'
+        self.stdout.write(self.style.SUCCESS('%d books with wrong counters %s' % (len(book_ids), verb)))
@@ -0,0 +1,66 @@
+import multiprocessing
+import os
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from bookHandler.jobs import claim_next_job, run_job, requeue_stale_jobs, schedule_periodic_tasks, queue_stats
+
+
+class Command(BaseCommand):
+    help = """Runs the background jobs (e-mails, reminders, cache rebuilds) queued by the web site, see
+        bookHandler/jobs.py. Starts --processes worker processes sharing the queue; stop them with Ctrl-C or SIGTERM,
+        each worker finishes its current job first."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=2, help='Number of worker processes')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between two checks of an empty queue')
+        parser.add_argument('--once', action='store_true', help='Exits when no job is left to run, instead of waiting for new ones')
+
+    def handle(self, *args, **options):
+        self.stopping = False
+        requeue_stale_jobs()
+        schedule_periodic_tasks()
+        if options['processes'] <= 1:
+            self.work(options['poll_interval'], options['once'])
+        else:
+            # Each process opens its own database connection, the parent's one must not be shared
+            connections.close_all()
+            workers = [multiprocessing.Process(target=self.work, args=(options['poll_interval'], options['once']))
+                for _ in range(options['processes'])]
+            for worker in workers:
+                worker.start()
+            try:
+                for worker in workers:
+                    worker.join()
+            except KeyboardInterrupt:
+                # The workers received the interrupt too, waiting for them to finish their current job
+                for worker in workers:
+                    worker.join()
+        stats = queue_stats()
+        if stats['nr_measured']:
+            self.stdout.write('Queue latency: avg %.2f s, p95 %.2f s, max %.2f s' % (stats['avg_latency'], stats['p95_latency'], stats['max_latency']))
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def work(self, poll_interval, once):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        pid = os.getpid()
+        while not self.stopping:
+            job = claim_next_job()
+            if job is None:
+                if once:
+                    break
+                time.sleep(poll_interval)
+                continue
+            waited = (job.started - job.run_after).total_seconds()
+            start = time.monotonic()
+            succeeded = run_job(job)
+            self.stdout.write('[%d] job %d %s: %s in %.1f ms, waited %.2f s in the queue' % (pid, job.id, job.name,
+                'done' if succeeded else 'failed (attempt %d/%d)' % (job.attempts, job.max_attempts),
+                (time.monotonic() - start) * 1000, waited))
+        connections.close_all()
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from bookHandler.reminders import scan_due_transactions, format_report, DUE_SOON_DAYS, REMINDER_INTERVAL_DAYS, SCAN_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = """Sends a reminder message to the borrowers of the books due back soon or overdue and prints a report.
+        Runs every day as a background job (see run_worker), this command runs it on demand."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help='Date of the scan (YYYY-MM-DD), today by default')
+        parser.add_argument('--due-soon-days', type=int, default=DUE_SOON_DAYS, help='Reminds the books due back within this number of days')
+        parser.add_argument('--interval-days', type=int, default=REMINDER_INTERVAL_DAYS, help='Minimum number of days between two reminders of the same book')
+        parser.add_argument('--chunk-size', type=int, default=SCAN_CHUNK_SIZE)
+        parser.add_argument('--dry-run', action='store_true', help='Only prints the report, no message is sent')
+
+    def handle(self, *args, **options):
+        today = None
+        if options['date']:
+            today = parse_date(options['date'])
+            if today is None:
+                raise CommandError('Invalid date "%s"' % options['date'])
+        report = scan_due_transactions(today=today, due_soon_days=options['due_soon_days'], interval_days=options['interval_days'],
+            chunk_size=options['chunk_size'], dry_run=options['dry_run'])
+        self.stdout.write(format_report(report))
@@ -0,0 +1,166 @@
+import random
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from bookHandler.fragment_cache import bump_book_versions
+from bookHandler.models import AbstractBook, ActualBook, Author, Genre, Message, Transaction, User
+from bookHandler.search import index_books
+
+WORDS = ('snow', 'mountain', 'river', 'winter', 'forest', 'night', 'story', 'garden', 'silent', 'journey', 'house',
+    'summer', 'lost', 'letters', 'island', 'shadow', 'light', 'memory', 'stone', 'wind', 'secret', 'city', 'fox', 'tea')
+GENRES = ('Novel', 'Crime', 'Fantasy', 'Science Fiction', 'History', 'Biography', 'Poetry', 'Travel', 'Children',
+    'Cooking', 'Outdoors', 'Manga')
+
+
+class Command(BaseCommand):
+    help = """Fills the database with generated members, books, transactions and messages for the benchmarks.
+        The default sizes (10k users, 100k abstract books, 300k copies, 1M transactions and messages) can be scaled
+        with --scale. Meant for an empty development database: the generated rows get explicit ids."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=float, default=1.0, help='Multiplies all the default sizes')
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--books', type=int, default=100000, help='Number of abstract books')
+        parser.add_argument('--copies', type=int, default=300000, help='Number of actual books')
+        parser.add_argument('--transactions', type=int, default=1000000)
+        parser.add_argument('--messages', type=int, default=1000000)
+        parser.add_argument('--seed', type=int, default=42, help='Seed of the random generator, for reproducible data')
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--skip-search-index', action='store_true', help='Does not index the generated books for the search')
+
+    def handle(self, *args, **options):
+        scale = options['scale']
+        sizes = {name: max(1, int(options[name] * scale)) for name in ('users', 'books', 'copies', 'transactions', 'messages')}
+        if sizes['users'] < 2:
+            raise CommandError('At least two users are needed to generate transactions')
+        self.random = random.Random(options['seed'])
+        self.chunk_size = options['chunk_size']
+        self.now = timezone.now()
+
+        user_ids = self.create_users(sizes['users'])
+        book_ids = self.create_books(sizes['books'])
+        copies = self.create_copies(sizes['copies'], book_ids, user_ids)
+        transaction_ids = self.create_transactions(sizes['transactions'], copies, user_ids)
+        self.create_messages(sizes['messages'], transaction_ids)
+        # bulk_create and update() do not maintain the copy and borrow counters of the books
+        AbstractBook.recount()
+        self.stdout.write('Book counters computed')
+        if not options['skip_search_index']:
+            for start in range(0, len(book_ids), 500):
+                index_books(book_ids[start:start+500])
+            self.stdout.write('Search index built')
+        # Nor the signals invalidating the cached pages, which a shared cache may still hold
+        for start in range(0, len(book_ids), 500):
+            bump_book_versions(book_ids[start:start+500])
+        self.stdout.write(self.style.SUCCESS('Created %(users)d users, %(books)d books, %(copies)d copies, '
+            '%(transactions)d transactions and %(messages)d messages' % sizes))
+
+    @staticmethod
+    def _next_id(model):
+        return (model.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+
+    def _bulk_create(self, model, objects):
+        with transaction.atomic():
+            model.objects.bulk_create(objects, batch_size=self.chunk_size)
+
+    def _random_date(self, max_days):
+        return self.now - timedelta(days=self.random.randint(0, max_days), seconds=self.random.randint(0, 86400))
+
+    def create_users(self, nr_users):
+        # Hashing the password once: all the generated members have the password 'benchmark'
+        password = make_password('benchmark')
+        first_id = self._next_id(User)
+        locations = [code for (code, label) in User.AREA_LOCATIONS]
+        for start in range(0, nr_users, self.chunk_size):
+            self._bulk_create(User, [User(id=first_id+i, username='member%d' % (first_id+i), password=password,
+                email='member%d@example.com' % (first_id+i), location=self.random.choice(locations),
+                date_joined=self._random_date(1000)) for i in range(start, min(nr_users, start+self.chunk_size))])
+        self.stdout.write('%d users created' % nr_users)
+        return list(range(first_id, first_id+nr_users))
+
+    def create_books(self, nr_books):
+        genres = [Genre.objects.get_or_create(name=name)[0] for name in GENRES]
+        first_author_id = self._next_id(Author)
+        nr_authors = max(1, nr_books // 5)
+        for start in range(0, nr_authors, self.chunk_size):
+            authors = []
+            for i in range(start, min(nr_authors, start+self.chunk_size)):
+                author = Author(id=first_author_id+i, last_name='Lastname%d' % (first_author_id+i), first_name=self.random.choice(WORDS).title())
+                author.name_key = Author.normalize_name('%s %s' % (author.last_name, author.first_name))
+                authors.append(author)
+            self._bulk_create(Author, authors)
+
+        first_id = self._next_id(AbstractBook)
+        for start in range(0, nr_books, self.chunk_size):
+            books, author_links, genre_links = [], [], []
+            for book_id in range(first_id+start, first_id+min(nr_books, start+self.chunk_size)):
+                title = ' '.join(self.random.choice(WORDS) for _ in range(self.random.randint(1, 4))).title()
+                books.append(AbstractBook(id=book_id, title=title, summary='A %s about %s.' % (self.random.choice(WORDS), title.lower()), isbn=''))
+                for author_id in set(self.random.randint(first_author_id, first_author_id+nr_authors-1) for _ in range(self.random.randint(1, 2))):
+                    author_links.append(AbstractBook.author.through(abstractbook_id=book_id, author_id=author_id))
+                genre_links.append(AbstractBook.genre.through(abstractbook_id=book_id, genre_id=self.random.choice(genres).id))
+            with transaction.atomic():
+                AbstractBook.objects.bulk_create(books)
+                AbstractBook.author.through.objects.bulk_create(author_links)
+                AbstractBook.genre.through.objects.bulk_create(genre_links)
+        self.stdout.write('%d authors and %d books created' % (nr_authors, nr_books))
+        return list(range(first_id, first_id+nr_books))
+
+    def create_copies(self, nr_copies, book_ids, user_ids):
+        """ Returns a list of (copy id, owner id) """
+        copies = []
+        for start in range(0, nr_copies, self.chunk_size):
+            chunk = [ActualBook(abstract_book_id=self.random.choice(book_ids), owner_id=self.random.choice(user_ids),
+                created_date=self._random_date(1000).date()) for _ in range(start, min(nr_copies, start+self.chunk_size))]
+            self._bulk_create(ActualBook, chunk)
+            copies.extend((copy.id, copy.owner_id) for copy in chunk)
+        self.stdout.write('%d copies created' % nr_copies)
+        return copies
+
+    def create_transactions(self, nr_transactions, copies, user_ids):
+        """ The last transaction of some copies is left active, and these copies are marked as borrowed """
+        transaction_ids = []
+        terminated_states = [Transaction.BOOK_RETURNED]*8 + [Transaction.REJECTED_REQUEST, Transaction.BOOK_LOST]
+        borrowed_copies = set()
+        for start in range(0, nr_transactions, self.chunk_size):
+            chunk = []
+            for i in range(start, min(nr_transactions, start+self.chunk_size)):
+                copy_id, owner_id = copies[i % len(copies)]
+                borrower_id = self.random.choice(user_ids)
+                while borrower_id == owner_id:
+                    borrower_id = self.random.choice(user_ids)
+                is_last = i + len(copies) >= nr_transactions
+                if is_last and copy_id not in borrowed_copies and self.random.random() < 0.2:
+                    state = self.random.choice(Transaction.ACTIVE_TRANSACTION)
+                    borrowed_copies.add(copy_id)
+                    lend_date = self.now - timedelta(days=self.random.randint(-7, 30))
+                else:
+                    state = self.random.choice(terminated_states)
+                    lend_date = self._random_date(1000)
+                chunk.append(Transaction(book_id=copy_id, lender_id=owner_id, borrower_id=borrower_id, transaction_state=state,
+                    created_date=(lend_date - timedelta(days=3)).date(), modified_timestamp=lend_date,
+                    lend_date=lend_date.date(), return_date=(lend_date + timedelta(days=30)).date()))
+            self._bulk_create(Transaction, chunk)
+            transaction_ids.extend((t.id, t.lender_id, t.borrower_id) for t in chunk)
+        borrowed_copies = list(borrowed_copies)
+        for start in range(0, len(borrowed_copies), 500):
+            ActualBook.objects.filter(id__in=borrowed_copies[start:start+500]).update(status=ActualBook.OUT_FOR_RENT, modified=self.now)
+        self.stdout.write('%d transactions created, %d copies currently borrowed' % (nr_transactions, len(borrowed_copies)))
+        return transaction_ids
+
+    def create_messages(self, nr_messages, transaction_ids):
+        for start in range(0, nr_messages, self.chunk_size):
+            chunk = []
+            for i in range(start, min(nr_messages, start+self.chunk_size)):
+                # Skewed distribution so that some conversations are long
+                transaction_id, lender_id, borrower_id = transaction_ids[int(len(transaction_ids) * self.random.random()**3)]
+                author_id, destination_id = (lender_id, borrower_id) if i % 2 else (borrower_id, lender_id)
+                chunk.append(Message(transaction_id=transaction_id, author_id=author_id, destination_id=destination_id,
+                    text=' '.join(self.random.choice(WORDS) for _ in range(8)), read=self.random.random() < 0.9,
+                    timestamp=self._random_date(1000)))
+            self._bulk_create(Message, chunk)
+        self.stdout.write('%d messages created' % nr_messages)
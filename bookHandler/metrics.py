@@ -0,0 +1,71 @@
+""" In-memory request metrics: query count, SQL time, template time and wall time per URL name.
+
+The values are kept per process in a rolling window of the last REQUEST_METRICS_WINDOW requests of each URL name,
+they are filled by bookHandler.middleware.RequestMetricsMiddleware and displayed by the staff page views.metrics_view.
+"""
+import threading
+from collections import defaultdict, deque
+from contextvars import ContextVar
+
+from django.conf import settings
+
+WINDOW = getattr(settings, 'REQUEST_METRICS_WINDOW', 1000)
+
+_lock = threading.Lock()
+_samples = defaultdict(lambda: deque(maxlen=WINDOW))
+
+# Timings of the request being processed, set by the middleware
+current_request_timings = ContextVar('current_request_timings', default=None)
+
+
+class RequestTimings:
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+
+
+def record_template_time(duration):
+    timings = current_request_timings.get()
+    if timings is not None:
+        timings.template_time += duration
+
+
+def record_request(url_name, timings, wall_time):
+    with _lock:
+        _samples[url_name].append((wall_time, timings.queries, timings.sql_time, timings.template_time))
+
+
+def reset():
+    with _lock:
+        _samples.clear()
+
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values)-1, int(len(sorted_values)*fraction))]
+
+
+def summary():
+    """ Returns one dict per URL name with percentiles (in milliseconds) of the wall time and averages of the other
+        measures, the URL names with the most total time first
+    """
+    with _lock:
+        samples = {url_name: list(values) for (url_name, values) in _samples.items()}
+    result = []
+    for url_name, values in samples.items():
+        wall_times = sorted(value[0] for value in values)
+        count = len(values)
+        result.append({
+            'url_name': url_name,
+            'count': count,
+            'total_ms': sum(wall_times) * 1000,
+            'p50_ms': _percentile(wall_times, 0.50) * 1000,
+            'p95_ms': _percentile(wall_times, 0.95) * 1000,
+            'p99_ms': _percentile(wall_times, 0.99) * 1000,
+            'avg_queries': sum(value[1] for value in values) / count,
+            'max_queries': max(value[1] for value in values),
+            'avg_sql_ms': sum(value[2] for value in values) / count * 1000,
+            'avg_template_ms': sum(value[3] for value in values) / count * 1000,
+        })
+    result.sort(key=lambda row: row['total_ms'], reverse=True)
+    return result
@@ -0,0 +1,92 @@
+import time
+from contextlib import ExitStack
+
+import django
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from .database import REPLICA_PREFIX, REPLICA_PIN_SECONDS, REPLICA_PIN_COOKIE, current_request_routing
+from .metrics import RequestTimings, current_request_timings, record_request
+
+
+class RequestMetricsMiddleware:
+    """ Measures, for each request, the number of SQL queries, the SQL time, the template rendering time (when the
+        TimedDjangoTemplates backend is used) and the wall time. They are sent back in a Server-Timing header and
+        aggregated per URL name in bookHandler.metrics.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings = RequestTimings()
+        token = current_request_timings.set(timings)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(self._count_query(timings)))
+                response = self.get_response(request)
+        finally:
+            current_request_timings.reset(token)
+        wall_time = time.perf_counter() - start
+
+        resolver_match = getattr(request, 'resolver_match', None)
+        url_name = resolver_match.view_name if resolver_match else '(unresolved)'
+        record_request(url_name, timings, wall_time)
+        response['Server-Timing'] = 'db;dur=%.2f;desc="%d queries", tpl;dur=%.2f, total;dur=%.2f' % (
+            timings.sql_time*1000, timings.queries, timings.template_time*1000, wall_time*1000)
+        return response
+
+    @staticmethod
+    def _count_query(timings):
+        def wrapper(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                timings.queries += 1
+                timings.sql_time += time.perf_counter() - start
+        return wrapper
+
+
+class DatabaseHealthCheckMiddleware:
+    """ Closes, before each request, the persistent connections (CONN_MAX_AGE) which are not usable anymore, e.g.
+        after a restart of the database server, so that the request opens a new one instead of failing.
+        Django 4.1 and later do it themselves with the CONN_HEALTH_CHECKS setting.
+    """
+
+    def __init__(self, get_response):
+        if django.VERSION >= (4, 1):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        for connection in connections.all():
+            if connection.connection is not None and connection.settings_dict['CONN_MAX_AGE'] != 0 and not connection.is_usable():
+                connection.close()
+        return self.get_response(request)
+
+
+class ReplicaPinningMiddleware:
+    """ Read-your-writes with the read replicas (see bookHandler/database.py): a request which writes to the database
+        sets a cookie expiring after REPLICA_PIN_SECONDS, and the requests bringing it back read from the primary only.
+        Not used without replicas.
+    """
+
+    def __init__(self, get_response):
+        if not any(alias.startswith(REPLICA_PREFIX) for alias in settings.DATABASES):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        routing = {'pinned': REPLICA_PIN_COOKIE in request.COOKIES, 'wrote': False}
+        token = current_request_routing.set(routing)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_request_routing.reset(token)
+        if routing['wrote']:
+            response.set_cookie(REPLICA_PIN_COOKIE, '1', max_age=REPLICA_PIN_SECONDS, httponly=True, samesite='Lax')
+        return response
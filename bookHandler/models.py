@@ -1,9 +1,19 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import Subquery
 from django.contrib.auth.models import AbstractUser
 import uuid
+import re
+import hashlib
+import secrets
+import unicodedata
 from django.utils import timezone
+from datetime import timedelta
 from django.conf import settings # for the settings.AUTH_USER_MODEL
 from django.urls import reverse
+from django.core.exceptions import ValidationError
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 
 # Create your models here.
 
@@ -44,12 +54,20 @@ class Message(models.Model):
     transaction = models.ForeignKey('Transaction', on_delete=models.SET_NULL, null=True, db_index=True, related_name='messages')
     text = models.TextField(max_length=500, blank=True)
     read = models.BooleanField(default=False, db_index=True)
-    timestamp = models.DateTimeField(auto_now_add=True, editable=False)
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
 
     class Meta:
         verbose_name = "Message"
         verbose_name_plural = "Messages"
         ordering = ['-timestamp']
+        indexes = [
+            # Conversation pages: messages of one transaction, by date
+            models.Index(fields=['transaction', 'timestamp']),
+            # Admin list: latest messages first (the admin adds the id to the ordering)
+            models.Index(fields=['timestamp', 'id']),
+            # Unread messages of a member
+            models.Index(fields=['destination', 'read']),
+        ]
     
     def __str__(self):
         return '%s to %s - %s' % (self.author, self.destination, self.text)
@@ -58,7 +76,7 @@ class Message(models.Model):
         """ Updates the created date value """
         if not self.id:
             self.timestamp = timezone.now()
-        return super(Message,self).save(args,kwargs)
+        return super(Message,self).save(*args, **kwargs)
 
 
 class Genre(models.Model):
@@ -77,7 +95,20 @@ class AbstractBook(models.Model):
     author = models.ManyToManyField('Author')
     summary = models.TextField(max_length=1000, help_text='Enter a quick description for the model')
     isbn = models.CharField('ISBN', max_length=13, help_text='International code (10 or 13 digits)')
+    # Canonical ISBN-13 computed from the isbn field (see normalize_isbn), used to find a book in one indexed lookup
+    isbn13 = models.CharField(max_length=13, unique=True, null=True, editable=False)
     genre = models.ManyToManyField(Genre, help_text='Select one or many genres for this book')
+    # Last change of the book or of what its page displays (see conditional.py), indexed for the catalogue Last-Modified
+    modified = models.DateTimeField(auto_now=True, db_index=True)
+    # Denormalised counters, so that the pages and the API show the availability and the popularity of a title without
+    # aggregating over its copies and their transactions. They are only written by add_to_counters (from ActualBook.save
+    # and Transaction.update_actual_book_status) and by recount (the recount_books command repairs them).
+    # Plain integers rather than positive ones: a drifted counter must not make the request decrementing it fail.
+    available_copies = models.IntegerField(default=0, editable=False)
+    total_copies = models.IntegerField(default=0, editable=False)
+    lifetime_borrows = models.IntegerField(default=0, editable=False)
+    active_requests = models.IntegerField(default=0, editable=False)
+    COUNTERS = ['available_copies', 'total_copies', 'lifetime_borrows', 'active_requests']
 
     def __str__(self):
         return self.title
@@ -85,15 +116,93 @@ class AbstractBook(models.Model):
     def get_absolute_url(self):
         return reverse('bookHandler:detail_abstract', args=[self.id])
 
+    def save(self, *args, **kwargs):
+        """ Keeps the canonical ISBN-13 in sync with the isbn field. Invalid ISBN are kept as typed but not indexed """
+        try:
+            self.isbn13 = AbstractBook.normalize_isbn(self.isbn)
+        except ValidationError:
+            self.isbn13 = None
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            # Saving a book loaded before one of its copies was borrowed must not write back the old counters
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in AbstractBook.COUNTERS]
+        return super(AbstractBook,self).save(*args, **kwargs)
+
+    @staticmethod
+    def add_to_counters(book_id, **deltas):
+        """ Adds the deltas (e.g. available_copies=-1) to the counters of a book with one UPDATE, in the database only """
+        deltas = {name: models.F(name) + delta for (name, delta) in deltas.items() if delta}
+        if deltas and book_id is not None:
+            AbstractBook.objects.filter(id=book_id).update(**deltas)
+
+    @staticmethod
+    def counter_expressions():
+        """ Returns the expressions computing each counter from the copies and the transactions of a book """
+        def count(queryset, group_by):
+            return Coalesce(Subquery(queryset.order_by().values(group_by).annotate(n=models.Count('*')).values('n')), 0)
+        copies = ActualBook.objects.filter(abstract_book=models.OuterRef('pk'))
+        transactions = Transaction.objects.filter(book__abstract_book=models.OuterRef('pk'))
+        return {
+            'available_copies': count(copies.filter(status=ActualBook.AVAILABLE), 'abstract_book'),
+            'total_copies': count(copies, 'abstract_book'),
+            'lifetime_borrows': count(transactions.filter(transaction_state__in=Transaction.BORROWED_STATES), 'book__abstract_book'),
+            'active_requests': count(transactions.filter(transaction_state__in=Transaction.PENDING_STATES), 'book__abstract_book'),
+        }
+
+    @staticmethod
+    def recount(books=None, dry_run=False, chunk_size=500):
+        """ Recomputes the counters of the given books (a queryset, all the books by default) and returns the ids of
+            the books whose counters were wrong. One aggregate query finds them, whatever the number of books, then
+            only these books are updated (and their pages marked as modified).
+        """
+        books = AbstractBook.objects.all() if books is None else books
+        wrong = models.Q()
+        for name in AbstractBook.COUNTERS:
+            wrong |= ~models.Q(**{name: models.F('expected_%s' % name)})
+        expected = {'expected_%s' % name: expression for (name, expression) in AbstractBook.counter_expressions().items()}
+        book_ids = list(books.annotate(**expected).filter(wrong).order_by('id').values_list('id', flat=True))
+        if not dry_run:
+            for start in range(0, len(book_ids), chunk_size):
+                AbstractBook.objects.filter(id__in=book_ids[start:start+chunk_size]).update(modified=timezone.now(),
+                    **AbstractBook.counter_expressions())
+        return book_ids
+
+    @staticmethod
+    def normalize_isbn(isbn):
+        """ Returns the ISBN-13 corresponding to an ISBN-10 or ISBN-13 string (dashes and spaces are ignored), 
+            None for an empty string, and raises a ValidationError if the check digit is wrong.
+        """
+        digits = re.sub(r'[\s-]', '', isbn or '').upper()
+        if digits == '':
+            return None
+        if re.fullmatch(r'\d{9}[\dX]', digits):
+            total = sum((10-i) * (10 if d == 'X' else int(d)) for i, d in enumerate(digits))
+            if total % 11 != 0:
+                raise ValidationError('Invalid ISBN-10 check digit', code='invalid_isbn')
+            digits = '978' + digits[:9]
+            return digits + str((10 - sum((1 if i % 2 == 0 else 3) * int(d) for i, d in enumerate(digits)) % 10) % 10)
+        if re.fullmatch(r'97[89]\d{10}', digits):
+            if sum((1 if i % 2 == 0 else 3) * int(d) for i, d in enumerate(digits)) % 10 != 0:
+                raise ValidationError('Invalid ISBN-13 check digit', code='invalid_isbn')
+            return digits
+        raise ValidationError('An ISBN must have 10 or 13 digits', code='invalid_isbn')
 
     @staticmethod
-    def get_or_create(title, author_list_string, book_summary=''):
+    def get_or_create(title, author_list_string, book_summary='', isbn=''):
         """
         get_or_create will look for the corresponding book and create it, if not found.
         title: String with the book title
         author_list_string: A list of strings containing Author names, preferably with LAST NAME first (e.g. Einstein Albert)
         book_summary: An (optional) string with the summary
+        isbn: An (optional) ISBN-10 or ISBN-13 string. When given, the book is first looked up by ISBN.
         """
+        isbn13 = AbstractBook.normalize_isbn(isbn)
+        if isbn13:
+            try:
+                return AbstractBook.objects.get(isbn13=isbn13)
+            except AbstractBook.DoesNotExist:
+                pass
+
         author_list = []
         for author_string in author_list_string:
             new_author = Author.get_or_create(author_string)
@@ -102,21 +211,33 @@ class AbstractBook(models.Model):
         query_filters = models.Q()
         if title != '':
             query_filters &= models.Q(title=title)
+        if isbn13:
+            # A book with the same title but another ISBN is another edition
+            query_filters &= models.Q(isbn13__isnull=True)
         results = AbstractBook.objects.filter(query_filters)
         for author in author_list:
-            # We supposed that the string is well constructed with LAST
-            query_filters = models.Q(author__last_name=author.last_name) & models.Q(author__first_name=author.first_name)
-            results = results.filter(query_filters) # We chain the filter instead of the Qs because of the ManyToMany relationship
-
-        if len(results) == 0:
-            new_book = AbstractBook(title=title, summary=book_summary, isbn='')
-            new_book.save() # The author 'ManyToMany' needs the object to be created in order to allow an author to be added
-            for author in author_list:
-                new_book.author.add(author)
-            new_book.save()
-            return new_book
-        else:
-            return results[0]
+            results = results.filter(author=author.id) # We chain the filter instead of the Qs because of the ManyToMany relationship
+
+        try:
+            if len(results) == 0:
+                # In one transaction, so that the search index of the new book is computed once (see search.py)
+                with transaction.atomic():
+                    new_book = AbstractBook(title=title, summary=book_summary, isbn=isbn13 or '')
+                    new_book.save() # The author 'ManyToMany' needs the object to be created in order to allow an author to be added
+                    new_book.author.add(*author_list)
+                return new_book
+            else:
+                book = results[0]
+                if isbn13:
+                    with transaction.atomic():
+                        book.isbn = isbn13
+                        book.save()
+                return book
+        except IntegrityError:
+            if not isbn13:
+                raise
+            # A book with this ISBN was created in the meantime by another request
+            return AbstractBook.objects.get(isbn13=isbn13)
 
 class ActualBook(models.Model):
     """ Model will represent an actual physical book, owned by someone and on the lend/borrow market """
@@ -134,13 +255,51 @@ class ActualBook(models.Model):
         (OUT_FOR_RENT, 'Borrowed'),
     )
     status = models.CharField(max_length=1, choices=BOOK_STATUS, default='a')
+    modified = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['-created_date']
+        indexes = [
+            # Available copies of a given title
+            models.Index(fields=['abstract_book', 'status']),
+            # Copies by status (admin list filter, available copies of the searched titles)
+            models.Index(fields=['status']),
+        ]
 
     def get_absolute_url(self):
         return reverse('bookHandler:detail_actual', args=[self.id])
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(ActualBook, cls).from_db(db, field_names, values)
+        # Title and status the counters of the abstract book currently account for (see save)
+        if 'abstract_book_id' in instance.__dict__ and 'status' in instance.__dict__:
+            instance._counted_as = (instance.abstract_book_id, instance.status)
+        return instance
+
+    def save(self, *args, **kwargs):
+        """ Saves the copy and updates the copy counters of its abstract book, in the same database transaction """
+        with transaction.atomic():
+            if self._state.adding:
+                previous = None
+            else:
+                previous = getattr(self, '_counted_as', None)
+                if previous is None:
+                    previous = ActualBook.objects.filter(id=self.id).values_list('abstract_book_id', 'status').first()
+            super(ActualBook,self).save(*args, **kwargs)
+            current = (self.abstract_book_id, self.status)
+            if previous != current:
+                if previous is not None and previous[0] == current[0]:
+                    AbstractBook.add_to_counters(current[0],
+                        available_copies=(current[1] == ActualBook.AVAILABLE) - (previous[1] == ActualBook.AVAILABLE))
+                else:
+                    if previous is not None:
+                        AbstractBook.add_to_counters(previous[0], total_copies=-1,
+                            available_copies=-(previous[1] == ActualBook.AVAILABLE))
+                    AbstractBook.add_to_counters(current[0], total_copies=1,
+                        available_copies=int(current[1] == ActualBook.AVAILABLE))
+            self._counted_as = current
+
     def __str__(self):
         return '%s - owned by %s (%s)' % (self.abstract_book.title,self.owner.username, self.id)
 
@@ -149,6 +308,10 @@ class Author(models.Model):
     first_name = models.CharField(max_length=100)
     last_name = models.CharField(max_length=100)
     bio = models.TextField(max_length=500, default='', null=True, verbose_name='biography')
+    # Normalised version of the name (see normalize_name), used to find an author in one indexed lookup
+    name_key = models.CharField(max_length=200, unique=True, null=True, editable=False)
+    # Last change of the author or of the list of their books (see conditional.py)
+    modified = models.DateTimeField(auto_now=True, db_index=True)
     class Meta:
         ordering = ['last_name', 'first_name']
     
@@ -158,33 +321,53 @@ class Author(models.Model):
     def __str__(self):
         return '%s %s' % (self.last_name, self.first_name)
 
+    def clean(self):
+        """ Two authors can't have the same normalised name (e.g. when an author is renamed in the admin) """
+        name_key = Author.normalize_name('%s %s' % (self.last_name, self.first_name))
+        if Author.objects.filter(name_key=name_key).exclude(pk=self.pk).exists():
+            raise ValidationError('An author with this name already exists', code='duplicate_author')
+
+    def save(self, *args, **kwargs):
+        """ Keeps the normalised name in sync with the first and last names """
+        self.name_key = Author.normalize_name('%s %s' % (self.last_name, self.first_name))
+        return super(Author,self).save(*args, **kwargs)
+
+    @staticmethod
+    def normalize_name(name):
+        """ Returns the key identifying an author name: case-folded, without accents nor punctuation, and with the
+            words sorted so that 'Murakami Haruki' and 'haruki MURAKAMI' give the same key.
+        """
+        name = unicodedata.normalize('NFKD', name)
+        name = ''.join(c for c in name if not unicodedata.combining(c)).casefold()
+        return ' '.join(sorted(re.findall(r'\w+', name)))
+
+    @staticmethod
+    def split_name(author):
+        """ Returns (last name, first name) of a name written LAST NAME FIRST (e.g. 'Einstein Albert'), without the
+            punctuation around the words (e.g. 'Barrie, James M.' gives ('Barrie', 'James M.'))
+        """
+        words = re.findall(r"\w[\w'.-]*", author)
+        if not words:
+            return '', ''
+        return words[0].title(), ' '.join(words[1:]).title()
+
     @staticmethod
     def get_or_create(author):
-        #First, assume last name first 
-        last_name = author.split()[0].title()
-        if len(author)>len(last_name):
-            first_name = author[len(last_name)+1:].title()
-        else:
-            first_name = ''
-        queryset_and = Author.objects.filter(first_name__iexact=first_name) & Author.objects.filter(last_name__iexact=last_name)
-        if len(queryset_and) == 0:
-            # Author not found - trying to reverse first and last name
-            last_name_2 = author.split()[-1].title()
-            if len(author)>len(last_name_2):
-                first_name_2 = author[:len(author)-len(last_name_2)].title().strip()
-            else:
-                first_name_2 = ''
-            queryset_and = Author.objects.filter(first_name__iexact=first_name_2) & Author.objects.filter(last_name__iexact=last_name_2)            
-            if len(queryset_and) == 0:
-                # Giving up - have to create a new author
-                # Using the initial variables (last_name, first_name) as they correspond to the LAST NAME FIRST convention (e.g. Einstein Albert)
+        author = author.strip()
+        try:
+            return Author.objects.get(name_key=Author.normalize_name(author))
+        except Author.DoesNotExist:
+            pass
+        # Author not found - creating it with the LAST NAME FIRST convention (e.g. Einstein Albert)
+        last_name, first_name = Author.split_name(author)
+        try:
+            with transaction.atomic():
                 new_author = Author(last_name=last_name, first_name=first_name)
                 new_author.save()
                 return new_author
-            else:
-                return queryset_and[0]
-        else:
-            return queryset_and[0]
+        except IntegrityError:
+            # Created in the meantime by another request
+            return Author.objects.get(name_key=Author.normalize_name(author))
         
 class Transaction(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, help_text='Unique ID for the transaction')
@@ -195,6 +378,8 @@ class Transaction(models.Model):
     modified_timestamp = models.DateTimeField(default=timezone.now, editable=False)
     lend_date = models.DateField(default=timezone.now)
     return_date = models.DateField(default=timezone.now)
+    # Date of the last reminder sent to the borrower, see bookHandler/reminders.py
+    reminder_date = models.DateField(null=True, blank=True, editable=False)
 
     INITIAL_REQUEST = 'i'
     APPROVED_REQUEST = 'a'
@@ -204,6 +389,9 @@ class Transaction(models.Model):
     EXTENSION = 'e'
     BOOK_LOST = 'z'
     ACTIVE_TRANSACTION = [INITIAL_REQUEST, APPROVED_REQUEST, BOOK_LENT, EXTENSION]
+    # Counted in AbstractBook.active_requests and AbstractBook.lifetime_borrows
+    PENDING_STATES = [INITIAL_REQUEST, APPROVED_REQUEST]
+    BORROWED_STATES = [BOOK_LENT, EXTENSION, BOOK_RETURNED, BOOK_LOST]
 
     TRANSACTION_STATUS = (
         (INITIAL_REQUEST, 'Initial Request'),
@@ -215,29 +403,95 @@ class Transaction(models.Model):
         (BOOK_LOST, 'Book Lost')
     )
     transaction_state = models.CharField(max_length=1, choices=TRANSACTION_STATUS, default='i')
+
+    # States which can follow each state. Staying in the same state (e.g. to change the dates) is always allowed.
+    ALLOWED_TRANSITIONS = {
+        INITIAL_REQUEST: [APPROVED_REQUEST, REJECTED_REQUEST],
+        APPROVED_REQUEST: [BOOK_LENT, REJECTED_REQUEST],
+        BOOK_LENT: [EXTENSION, BOOK_RETURNED, BOOK_LOST],
+        EXTENSION: [BOOK_RETURNED, BOOK_LOST],
+        REJECTED_REQUEST: [],
+        BOOK_RETURNED: [],
+        BOOK_LOST: [],
+    }
     
     class Meta:
         ordering=['-lend_date']
+        indexes = [
+            # Scan of the books due back soon or overdue
+            models.Index(fields=['transaction_state', 'return_date']),
+            # Recent activity, for the trending books (see bookHandler/trending.py)
+            models.Index(fields=['created_date']),
+            # Transactions changed since the last refresh of the recommendations (see bookHandler/recommendations.py)
+            models.Index(fields=['modified_timestamp']),
+            # Books lent in a given month, for the club reports (see bookHandler/reports.py)
+            models.Index(fields=['lend_date']),
+        ]
 
     def __str__(self):
         return '"%s" on %s btw %s and %s' % (self.book.abstract_book.title, self.lend_date, self.book.owner, self.borrower)
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Transaction, cls).from_db(db, field_names, values)
+        # State the counters of the abstract book currently account for (see update_actual_book_status)
+        instance._counted_state = instance.__dict__.get('transaction_state')
+        return instance
+
     def save(self, *args, **kwargs):
         """ Updates the created date value """
         if not self.id:
             self.created_date = timezone.now()
         self.modified_timestamp = timezone.now()
-        return super(Transaction,self).save(args,kwargs)
+        return super(Transaction,self).save(*args, **kwargs)
     
     def is_active(self):
         return self.transaction_state in self.ACTIVE_TRANSACTION
     
     def is_terminated(self):
         return not self.transaction_state in self.ACTIVE_TRANSACTION
+
+    def allowed_states(self):
+        """ Returns the list of states this transaction can be put in, starting with the current one """
+        return [self.transaction_state] + Transaction.ALLOWED_TRANSITIONS[self.transaction_state]
+
+    def change_state(self, new_state):
+        """ Changes the state of the transaction (without saving it), raising a ValidationError if the state machine
+            does not allow going from the current state to the new one
+        """
+        if new_state not in self.allowed_states():
+            raise ValidationError('A transaction in state "%s" cannot go to "%s"' % (self.get_transaction_state_display(),
+                dict(Transaction.TRANSACTION_STATUS).get(new_state, new_state)), code='invalid_transition')
+        self.transaction_state = new_state
+
+    @staticmethod
+    def create_request(actual_book, borrower):
+        """ Creates a new borrowing request on an available book and marks the book as borrowed.
+            The book is reserved with a conditional UPDATE (... WHERE status = 'available'), so when several members
+            request the same copy at the same time only one of them gets it; the others get a ValidationError.
+        """
+        if actual_book.owner_id == borrower.id:
+            raise ValidationError('You cannot borrow your own books!', code='own_book')
+        with transaction.atomic():
+            reserved = (ActualBook.objects.filter(id=actual_book.id, status=ActualBook.AVAILABLE)
+                .update(status=ActualBook.OUT_FOR_RENT, modified=timezone.now()))
+            if not reserved:
+                raise ValidationError('This book is not available', code='not_available')
+            new_request = Transaction(book=actual_book, lender_id=actual_book.owner_id, borrower=borrower,
+                lend_date=timezone.now() + timedelta(days=7),
+                return_date=timezone.now() + timedelta(days=37),
+                transaction_state=Transaction.INITIAL_REQUEST)
+            new_request.save()
+            # Saving the book again through the model (the row is already locked by the update) so that the save
+            # signals run and the counters are updated. The update above proves that the book was available.
+            actual_book._counted_as = (actual_book.abstract_book_id, ActualBook.AVAILABLE)
+            new_request.update_actual_book_status()
+        return new_request
     
     def update_actual_book_status(self):
         """ This method is expected to be called after transaction status is updated.
-            It will update the Actual Book status according to the transaction state in order to make sure that both are consistent
+            It will update the Actual Book status according to the transaction state in order to make sure that both are consistent,
+            and the request and borrow counters of the abstract book.
         """
         if self.transaction_state in [Transaction.INITIAL_REQUEST, Transaction.APPROVED_REQUEST, Transaction.BOOK_LENT, Transaction.EXTENSION]:
             self.book.status = ActualBook.OUT_FOR_RENT
@@ -245,6 +499,165 @@ class Transaction(models.Model):
             self.book.status = ActualBook.UNAVAILABLE
         else:
             self.book.status = ActualBook.AVAILABLE
-        self.book.save()
+        previous_state = getattr(self, '_counted_state', None)
+        with transaction.atomic():
+            self.book.save()
+            AbstractBook.add_to_counters(self.book.abstract_book_id,
+                active_requests=(self.transaction_state in Transaction.PENDING_STATES) - (previous_state in Transaction.PENDING_STATES),
+                lifetime_borrows=(self.transaction_state in Transaction.BORROWED_STATES) - (previous_state in Transaction.BORROWED_STATES))
+        self._counted_state = self.transaction_state
 
     
+
+
+class SearchToken(models.Model):
+    """ Entry of the search inverted index: one token found in the title, summary, authors or genres of an abstract book.
+        The rows are maintained by the signal handlers in bookHandler/search.py, they should not be edited by hand.
+    """
+    token = models.CharField(max_length=50)
+    book = models.ForeignKey(AbstractBook, on_delete=models.CASCADE, related_name='search_tokens')
+    weight = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        unique_together = [['token', 'book']]
+
+    def __str__(self):
+        return '%s -> %s (%d)' % (self.token, self.book_id, self.weight)
+
+
+class TrendingBook(models.Model):
+    """ Entry of the trending books ranking. The table is recomputed periodically by the 'compute_trending_books' job,
+        see bookHandler/trending.py
+    """
+    rank = models.PositiveIntegerField(unique=True)
+    book = models.ForeignKey(AbstractBook, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+    computed = models.DateTimeField()
+
+    class Meta:
+        ordering = ['rank']
+
+    def __str__(self):
+        return '%d. %s (%.2f)' % (self.rank, self.book_id, self.score)
+
+
+class RelatedBook(models.Model):
+    """ 'Members who borrowed this also borrowed': one of the nearest neighbours of a book in the co-borrow matrix.
+        The rows are computed by bookHandler/recommendations.py, they should not be edited by hand.
+    """
+    book = models.ForeignKey(AbstractBook, on_delete=models.CASCADE, related_name='related_books')
+    related = models.ForeignKey(AbstractBook, on_delete=models.CASCADE, related_name='+')
+    rank = models.PositiveIntegerField()
+    # Cosine similarity of the sets of borrowers of the two books, and the number of borrowers they have in common
+    score = models.FloatField()
+    common_borrowers = models.PositiveIntegerField()
+    computed = models.DateTimeField()
+
+    class Meta:
+        ordering = ['book', 'rank']
+        unique_together = [['book', 'rank']]
+
+    def __str__(self):
+        return '%s -> %s (%.2f)' % (self.book_id, self.related_id, self.score)
+
+
+class RelatedBooksRefresh(models.Model):
+    """ A successful computation of the RelatedBook rows. The next refresh starts from the latest one """
+    # The transactions changed up to this time are taken into account
+    computed = models.DateTimeField(db_index=True)
+    full = models.BooleanField()
+    books = models.PositiveIntegerField()
+    rows = models.PositiveIntegerField()
+    duration = models.FloatField()
+
+    class Meta:
+        ordering = ['-computed']
+
+    def __str__(self):
+        return '%s refresh of %s' % ('Full' if self.full else 'Incremental', self.computed)
+
+
+class MonthlyReport(models.Model):
+    """ Statistics of one finished month (see bookHandler/reports.py), computed once and never updated """
+    month = models.DateField(unique=True, help_text='First day of the month')
+    data = models.TextField(help_text='Report in JSON')
+    computed = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        ordering = ['-month']
+
+    def __str__(self):
+        return 'Report of %s' % self.month.strftime('%Y-%m')
+
+
+class ApiToken(models.Model):
+    """ Key authenticating the API requests of a member's device (see bookHandler/api.py). Only a hash of the key is
+        stored, the key itself is given once to the device
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='api_tokens')
+    name = models.CharField(max_length=100, blank=True, help_text='Device using the token')
+    key_hash = models.CharField(max_length=64, unique=True, editable=False)
+    created = models.DateTimeField(default=timezone.now, editable=False)
+
+    def __str__(self):
+        return '%s (%s)' % (self.user, self.name or self.created)
+
+    @staticmethod
+    def hash_key(key):
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    @staticmethod
+    def create_key(user, name=''):
+        """ Creates a token for the user and returns its key """
+        key = secrets.token_urlsafe(30)
+        ApiToken.objects.create(user=user, name=name, key_hash=ApiToken.hash_key(key))
+        return key
+
+    @staticmethod
+    def authenticate(key):
+        """ Returns the token of an active member having this key, None if there is none """
+        return ApiToken.objects.select_related('user').filter(key_hash=ApiToken.hash_key(key), user__is_active=True).first()
+
+
+class Job(models.Model):
+    """ Background task waiting to be run (or already run) by the 'run_worker' command. See bookHandler/jobs.py """
+    QUEUED = 'q'
+    RUNNING = 'r'
+    DONE = 'd'
+    FAILED = 'f'
+    JOB_STATUS = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+    name = models.CharField(max_length=100)
+    payload = models.TextField(default='{}', help_text='Keyword arguments of the task, in JSON')
+    status = models.CharField(max_length=1, choices=JOB_STATUS, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    created = models.DateTimeField(default=timezone.now, editable=False)
+    run_after = models.DateTimeField(default=timezone.now)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+
+    class Meta:
+        indexes = [
+            # Next job to run
+            models.Index(fields=['status', 'run_after']),
+        ]
+
+    def __str__(self):
+        return '%s (%s, %s)' % (self.name, self.get_status_display(), self.created)
+
+
+# Deleting a copy or a transaction (also through a cascade, e.g. when a member is deleted) recounts its abstract book
+@receiver(post_delete, sender=ActualBook)
+def _copy_deleted(sender, instance, **kwargs):
+    AbstractBook.recount(AbstractBook.objects.filter(id=instance.abstract_book_id))
+
+
+@receiver(post_delete, sender=Transaction)
+def _transaction_deleted(sender, instance, **kwargs):
+    AbstractBook.recount(AbstractBook.objects.filter(instances=instance.book_id))
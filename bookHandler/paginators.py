@@ -0,0 +1,45 @@
+""" Paginator of the admin lists of the large tables (transactions, messages, copies...).
+
+Django's paginator counts the rows of the list with a COUNT(*), which reads the whole table. For an unfiltered list of
+a table larger than APPROXIMATE_COUNT_THRESHOLD rows, ApproximateCountPaginator uses the row estimate kept by the
+database instead (PostgreSQL and MySQL statistics), read in constant time. Filtered lists (list filters, searches) are
+counted exactly, the filters of the admin lists being indexed.
+The number of pages can then be slightly off, the last page being empty or missing a few rows.
+SQLite keeps no row estimate (the largest rowid counts the deleted rows too, e.g. the search tokens or the related
+books rewritten again and again), so its lists are always counted exactly.
+"""
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+APPROXIMATE_COUNT_THRESHOLD = 10000
+
+
+def estimated_count(model, using='default'):
+    """ Returns the estimated number of rows of the table of a model, or None when the database has no estimate """
+    connection = connections[using]
+    table = model._meta.db_table
+    if connection.vendor == 'postgresql':
+        # -1 when the table was never analysed
+        sql = 'SELECT reltuples FROM pg_class WHERE relname = %s'
+    elif connection.vendor == 'mysql':
+        sql = 'SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s'
+    else:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [table])
+        row = cursor.fetchone()
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+class ApproximateCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if hasattr(queryset, 'query') and not queryset.query.where:
+            estimate = estimated_count(queryset.model, queryset.db)
+            if estimate is not None and estimate >= APPROXIMATE_COUNT_THRESHOLD:
+                return estimate
+        return super(ApproximateCountPaginator,self).count
@@ -0,0 +1,160 @@
+""" 'Members who borrowed this also borrowed': item-to-item recommendations from the borrowing history.
+
+The history is a borrower x abstract book matrix (1 when the member borrowed a copy of the title at least once). Two
+books are similar when the same members borrowed them: the score is the cosine similarity of their columns,
+    common borrowers / sqrt(borrowers of the first book * borrowers of the second book)
+and the RELATED_SIZE most similar books of each book are stored in the RelatedBook table, so the book page reads them
+with one indexed query.
+
+The computation is done offline by the 'refresh_related_books' job (and the compute_related_books command), with
+SciPy sparse matrices when NumPy and SciPy are installed, in pure Python otherwise (fine for a club sized history).
+A refresh only recomputes the books whose co-borrow counts changed since the previous successful one (recorded in the
+RelatedBooksRefresh table once all its rows are written): the books of the changed transactions and the other books of
+their borrowers. The scores of the other lists only move slightly through the number of borrowers of the changed books,
+and are brought up to date by a full computation (--full).
+"""
+import heapq
+import time
+from collections import Counter, defaultdict
+from math import sqrt
+
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import RelatedBook, RelatedBooksRefresh, Transaction
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    numpy = sparse = None
+
+RELATED_SIZE = 5
+# Minimum number of members who borrowed both books
+MIN_COMMON_BORROWERS = 1
+# Number of books whose neighbours are computed (and written) at a time
+RELATED_CHUNK_SIZE = 1000
+
+
+def borrow_pairs():
+    """ Returns the distinct (borrower id, abstract book id) of the books which were actually lent """
+    return list(Transaction.objects
+        .filter(transaction_state__in=Transaction.BORROWED_STATES, borrower__isnull=False)
+        .order_by()
+        .values_list('borrower', 'book__abstract_book')
+        .distinct())
+
+
+def _neighbours_python(pairs, book_ids, size, min_common):
+    books_of = defaultdict(list)
+    borrowers_of = defaultdict(list)
+    for (borrower_id, book_id) in pairs:
+        books_of[borrower_id].append(book_id)
+        borrowers_of[book_id].append(borrower_id)
+    for book_id in book_ids:
+        borrowers = borrowers_of.get(book_id, [])
+        common = Counter(other_id for borrower_id in borrowers for other_id in books_of[borrower_id] if other_id != book_id)
+        scored = [(other_id, count, count / sqrt(len(borrowers) * len(borrowers_of[other_id])))
+            for (other_id, count) in common.items() if count >= min_common]
+        yield book_id, heapq.nsmallest(size, scored, key=lambda neighbour: (-neighbour[2], neighbour[0]))
+
+
+def _neighbours_numpy(pairs, book_ids, size, min_common):
+    borrower_index = {}
+    book_index = {}
+    rows = [borrower_index.setdefault(borrower_id, len(borrower_index)) for (borrower_id, book_id) in pairs]
+    columns = [book_index.setdefault(book_id, len(book_index)) for (borrower_id, book_id) in pairs]
+    column_ids = numpy.array(list(book_index), dtype=numpy.int64)
+    matrix = sparse.csc_matrix((numpy.ones(len(pairs)), (rows, columns)), shape=(len(borrower_index), len(book_index)))
+    nr_borrowers = numpy.asarray(matrix.sum(axis=0)).ravel()
+    targets = [book_id for book_id in book_ids if book_id in book_index]
+    for book_id in book_ids:
+        if book_id not in book_index:
+            yield book_id, []
+    for start in range(0, len(targets), RELATED_CHUNK_SIZE):
+        chunk = [book_index[book_id] for book_id in targets[start:start+RELATED_CHUNK_SIZE]]
+        # Co-borrow counts of the books of the chunk with every book: (chunk x borrowers) . (borrowers x books)
+        common = (matrix[:, chunk].T @ matrix).tocsr()
+        for (i, column) in enumerate(chunk):
+            others = common.indices[common.indptr[i]:common.indptr[i+1]]
+            counts = common.data[common.indptr[i]:common.indptr[i+1]]
+            keep = (others != column) & (counts >= min_common)
+            others, counts = others[keep], counts[keep]
+            scores = counts / numpy.sqrt(nr_borrowers[column] * nr_borrowers[others])
+            # Best scores first, then smallest book ids, like the pure Python version
+            order = numpy.lexsort((column_ids[others], -scores))[:size]
+            yield int(column_ids[column]), [(int(column_ids[others[j]]), int(counts[j]), float(scores[j])) for j in order]
+
+
+def nearest_neighbours(pairs, book_ids, size=RELATED_SIZE, min_common=MIN_COMMON_BORROWERS):
+    """ Yields (book id, [(related book id, common borrowers, score), ...] best first) for each of the given books """
+    neighbours = _neighbours_numpy if sparse is not None else _neighbours_python
+    return neighbours(pairs, book_ids, size, min_common)
+
+
+def refresh_related_books(full=False, size=RELATED_SIZE, min_common=MIN_COMMON_BORROWERS):
+    """ Recomputes the RelatedBook rows of the books whose co-borrow counts changed since the last refresh (of all the
+        books with full, or when there is no previous refresh). Returns a report (dictionary)
+    """
+    start = time.monotonic()
+    # Transactions changed while computing are seen by the next refresh
+    computed = timezone.now()
+    since = None if full else RelatedBooksRefresh.objects.aggregate(latest=Max('computed'))['latest']
+    pairs = borrow_pairs()
+    if since is None:
+        book_ids = sorted({book_id for (borrower_id, book_id) in pairs})
+    else:
+        changed = Transaction.objects.filter(modified_timestamp__gt=since, modified_timestamp__lte=computed).order_by()
+        borrower_ids = set(changed.exclude(borrower=None).values_list('borrower', flat=True))
+        book_ids = set(changed.values_list('book__abstract_book', flat=True))
+        book_ids.update(book_id for (borrower_id, book_id) in pairs if borrower_id in borrower_ids)
+        book_ids = sorted(book_ids)
+
+    def write(chunk):
+        with transaction.atomic():
+            RelatedBook.objects.filter(book__in=[book_id for (book_id, neighbours) in chunk]).delete()
+            RelatedBook.objects.bulk_create([RelatedBook(book_id=book_id, related_id=related_id, rank=rank,
+                    common_borrowers=common, score=score, computed=computed)
+                for (book_id, neighbours) in chunk for rank, (related_id, common, score) in enumerate(neighbours, 1)])
+        return sum(len(neighbours) for (book_id, neighbours) in chunk)
+
+    def write_all():
+        nr_rows = 0
+        chunk = []
+        for (book_id, neighbours) in nearest_neighbours(pairs, book_ids, size, min_common):
+            chunk.append((book_id, neighbours))
+            if len(chunk) >= RELATED_CHUNK_SIZE:
+                nr_rows += write(chunk)
+                chunk = []
+        if chunk:
+            nr_rows += write(chunk)
+        return nr_rows
+
+    if since is None:
+        # A full computation is written by chunks, not to block the other writers for the whole computation. If it
+        # fails, the next refresh starts again from the previous successful one
+        nr_rows = write_all()
+        # Books which are not borrowed anymore (e.g. their copies were deleted)
+        RelatedBook.objects.exclude(computed=computed).delete()
+        refresh = RelatedBooksRefresh.objects.create(computed=computed, full=True, books=len(book_ids), rows=nr_rows,
+            duration=time.monotonic() - start)
+    else:
+        # An incremental refresh is written in one database transaction: if it fails, the next refresh does it again
+        with transaction.atomic():
+            nr_rows = write_all()
+            refresh = RelatedBooksRefresh.objects.create(computed=computed, full=False, books=len(book_ids), rows=nr_rows,
+                duration=time.monotonic() - start)
+    return {
+        'full': refresh.full,
+        'engine': 'scipy' if sparse is not None else 'python',
+        'borrows': len(pairs),
+        'books': refresh.books,
+        'rows': refresh.rows,
+        'duration': refresh.duration,
+    }
+
+def related_books(book_id):
+    """ Returns the RelatedBook rows of a book, best first, with the related book titles, in one query """
+    return list(RelatedBook.objects.filter(book=book_id).select_related('related')
+        .only('rank', 'score', 'common_borrowers', 'related', 'related__title').order_by('rank'))
@@ -0,0 +1,140 @@
+""" Daily scan of the lent books which are due back soon or overdue.
+
+The scan reads the lent transactions through the (transaction_state, return_date) index, streaming the rows with
+iterator() so that the memory used does not depend on the number of transactions, and writes one reminder message
+to the borrower per transaction and per chunk with bulk_create. The borrowers of the overdue books are also sent the
+reminder by e-mail, through one connection to the mail server per chunk. Transaction.reminder_date records the last
+reminder (after its e-mail was sent), so that a borrower gets at most one reminder (message and e-mail) every REMINDER_INTERVAL_DAYS days for the
+same book.
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import get_connection, EmailMessage
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Message, Transaction
+from .unread import messages_created
+
+# A reminder is sent this number of days before the return date
+DUE_SOON_DAYS = 3
+# Minimum number of days between two reminders for the same transaction
+REMINDER_INTERVAL_DAYS = 3
+SCAN_CHUNK_SIZE = 2000
+
+# Only the books actually in the hands of the borrower have a meaningful return date
+LENT_STATES = [Transaction.BOOK_LENT, Transaction.EXTENSION]
+
+# Groups of overdue transactions in the report: (maximum number of days overdue, label)
+OVERDUE_BUCKETS = ((7, '1-7 days'), (30, '8-30 days'), (None, 'more than 30 days'))
+
+
+def _bucket_label(days_overdue):
+    for (upper, label) in OVERDUE_BUCKETS:
+        if upper is None or days_overdue <= upper:
+            return label
+
+
+def _reminder_text(title, return_date, days_overdue):
+    if days_overdue > 0:
+        return ('Reminder: "%s" should have been returned on %s (%d day%s ago). Please return it or ask the owner for '
+            'an extension.' % (title, return_date, days_overdue, '' if days_overdue == 1 else 's'))
+    return 'Reminder: "%s" is due back on %s.' % (title, return_date)
+
+
+def _reminder_email(row):
+    (transaction_id, return_date, title, borrower_id, borrower_name, borrower_email, lender_name) = row
+    return EmailMessage('[Niseko Book Club] Please return "%s"' % title,
+        'Hello %s,\n\nThe copy of "%s" you borrowed from %s should have been returned on %s. Please return it or '
+        'ask %s for an extension.\n' % (borrower_name, title, lender_name, return_date, lender_name),
+        settings.DEFAULT_FROM_EMAIL, [borrower_email])
+
+
+def scan_due_transactions(today=None, due_soon_days=DUE_SOON_DAYS, interval_days=REMINDER_INTERVAL_DAYS,
+        chunk_size=SCAN_CHUNK_SIZE, dry_run=False):
+    """ Sends the reminders of the day and returns a report (dictionary) of what was found.
+        With dry_run, only the report is computed.
+    """
+    start = time.monotonic()
+    today = today or timezone.localdate()
+    due = (Transaction.objects
+        .filter(transaction_state__in=LENT_STATES, return_date__lte=today + timedelta(days=due_soon_days))
+        .filter(Q(reminder_date=None) | Q(reminder_date__lte=today - timedelta(days=interval_days)))
+        .order_by()
+        .values_list('id', 'return_date', 'book__abstract_book__title', 'borrower_id', 'borrower__username', 'borrower__email',
+            'lender__username'))
+    report = {
+        'date': today,
+        'due_soon': 0,
+        'overdue': 0,
+        'due_soon_days': due_soon_days,
+        'overdue_by_age': {label: 0 for (upper, label) in OVERDUE_BUCKETS},
+        'max_days_overdue': 0,
+        'messages': 0,
+        'emails': 0,
+        'chunks': 0,
+    }
+    chunk = []
+    for row in due.iterator(chunk_size=chunk_size):
+        days_overdue = (today - row[1]).days
+        if days_overdue > 0:
+            report['overdue'] += 1
+            report['overdue_by_age'][_bucket_label(days_overdue)] += 1
+            report['max_days_overdue'] = max(report['max_days_overdue'], days_overdue)
+        else:
+            report['due_soon'] += 1
+        if not dry_run:
+            chunk.append((row, days_overdue))
+            if len(chunk) >= chunk_size:
+                _send_reminders(chunk, today, report)
+                chunk = []
+    if chunk:
+        _send_reminders(chunk, today, report)
+    report['duration'] = time.monotonic() - start
+    return report
+
+
+def _send_reminders(chunk, today, report):
+    # The e-mails are sent one by one before the reminders are recorded: when the mail server fails, the reminders
+    # whose e-mail went out are still recorded, so the retry of the job only sends the others
+    sent = []
+    connection = get_connection()
+    try:
+        for (row, days_overdue) in chunk:
+            if days_overdue > 0 and row[5]:
+                # One connection to the mail server for the chunk, opened by the first e-mail
+                connection.open()
+                connection.send_messages([_reminder_email(row)])
+                report['emails'] += 1
+            sent.append((row, days_overdue))
+    finally:
+        connection.close()
+        _record_reminders(sent, today, report)
+
+
+def _record_reminders(sent, today, report):
+    reminders = [Message(author=None, destination_id=borrower_id, transaction_id=transaction_id,
+            text=_reminder_text(title, return_date, days_overdue))
+        for ((transaction_id, return_date, title, borrower_id, borrower_name, borrower_email, lender_name), days_overdue) in sent
+        if borrower_id is not None]
+    with transaction.atomic():
+        Message.objects.bulk_create(reminders)
+        # reminder_date is not part of the scanned index, so updating it does not disturb the running iterator
+        Transaction.objects.filter(id__in=[row[0] for (row, days_overdue) in sent]).update(reminder_date=today)
+    messages_created(reminders)
+    report['messages'] += len(reminders)
+    report['chunks'] += 1
+
+
+def format_report(report):
+    lines = ['Due back report of %s' % report['date'],
+        '%d books due back within %d days, %d overdue (oldest: %d days)' % (report['due_soon'], report['due_soon_days'],
+            report['overdue'], report['max_days_overdue'])]
+    for label, count in report['overdue_by_age'].items():
+        lines.append('  overdue by %s: %d' % (label, count))
+    lines.append('%d reminders sent (%d by e-mail) in %d chunks, %.2f s' % (report['messages'], report['emails'], report['chunks'],
+        report['duration']))
+    return '\n'.join(lines)
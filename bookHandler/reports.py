@@ -0,0 +1,130 @@
+""" Monthly statistics of the club, for the organisers (see the club_report command).
+
+For each month:
+    borrows         books lent during the month (lend date in the month), per area of the borrower and per genre
+    returned, lost  loans which ended during the month (return date in the month), as returned or lost
+    loan length     average number of days between the lend and return dates of the returned books
+    loss rate       lost / (returned + lost)
+Every figure is a GROUP BY or an aggregate computed by the database, through the lend_date and the
+(transaction_state, return_date) indexes, so the transactions are never loaded in memory.
+
+The figures of a month keep changing after it ends: a request planned for the month is only lent later, a loan due
+back in the month is returned or declared lost weeks later. A month is considered settled REPORT_SETTLING_DAYS days
+after its end (a loan is requested for 30 days starting a week later, plus a margin for the late returns): from then
+on its report is stored once in the MonthlyReport table and read from there. The reports of the more recent months are
+always computed.
+"""
+import csv
+import json
+from datetime import timedelta
+
+from django.db import IntegrityError
+from django.db.models import Avg, Count, DurationField, ExpressionWrapper, F, Q
+from django.utils import timezone
+
+from .models import MonthlyReport, Transaction, User
+
+UNKNOWN = 'Unknown'
+NO_GENRE = 'No genre'
+
+REPORT_SETTLING_DAYS = 90
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def next_month(month):
+    return month_start(month + timedelta(days=32))
+
+
+def previous_months(last_month, nr_months):
+    """ Returns the first days of the nr_months months ending with last_month, oldest first """
+    months = [month_start(last_month)]
+    while len(months) < nr_months:
+        months.insert(0, month_start(months[0] - timedelta(days=1)))
+    return months
+
+
+def compute_report(month):
+    """ Computes the report of the month starting on the given day """
+    end = next_month(month)
+    borrows = (Transaction.objects
+        .filter(transaction_state__in=Transaction.BORROWED_STATES, lend_date__gte=month, lend_date__lt=end)
+        .order_by())
+    areas = dict(User.AREA_LOCATIONS)
+    by_area = {}
+    for (location, count) in borrows.values_list('borrower__location').annotate(count=Count('id')):
+        label = areas.get(location, UNKNOWN)
+        by_area[label] = by_area.get(label, 0) + count
+    # A book with several genres counts in each of them
+    by_genre = {genre or NO_GENRE: count for (genre, count)
+        in borrows.values_list('book__abstract_book__genre__name').annotate(count=Count('id'))}
+
+    ended = (Transaction.objects
+        .filter(transaction_state__in=[Transaction.BOOK_RETURNED, Transaction.BOOK_LOST], return_date__gte=month, return_date__lt=end)
+        .aggregate(
+            returned=Count('id', filter=Q(transaction_state=Transaction.BOOK_RETURNED)),
+            lost=Count('id', filter=Q(transaction_state=Transaction.BOOK_LOST)),
+            loan_length=Avg(ExpressionWrapper(F('return_date') - F('lend_date'), output_field=DurationField()),
+                filter=Q(transaction_state=Transaction.BOOK_RETURNED))))
+    nr_ended = ended['returned'] + ended['lost']
+    return {
+        'month': month.strftime('%Y-%m'),
+        'borrows': sum(by_area.values()),
+        'borrows_by_area': dict(sorted(by_area.items())),
+        'borrows_by_genre': dict(sorted(by_genre.items())),
+        'returned': ended['returned'],
+        'lost': ended['lost'],
+        'average_loan_days': round(ended['loan_length'].total_seconds() / 86400, 1) if ended['loan_length'] is not None else None,
+        'loss_rate': round(ended['lost'] / nr_ended, 4) if nr_ended else None,
+    }
+
+
+def get_report(month, today=None):
+    """ Returns the report of the month starting on the given day, from its snapshot when the month is settled """
+    today = today or timezone.localdate()
+    if next_month(month) + timedelta(days=REPORT_SETTLING_DAYS) > today:
+        return compute_report(month)
+    snapshot = MonthlyReport.objects.filter(month=month).first()
+    if snapshot is not None:
+        return json.loads(snapshot.data)
+    report = compute_report(month)
+    try:
+        MonthlyReport.objects.create(month=month, data=json.dumps(report))
+    except IntegrityError:
+        # Stored in the meantime by another process: the first snapshot is the reference
+        return json.loads(MonthlyReport.objects.get(month=month).data)
+    return report
+
+
+def format_report(report):
+    lines = ['Club report of %s' % report['month'],
+        '%d books lent' % report['borrows']]
+    for label, count in report['borrows_by_area'].items():
+        lines.append('  %s: %d' % (label, count))
+    lines.append('By genre:')
+    for label, count in report['borrows_by_genre'].items():
+        lines.append('  %s: %d' % (label, count))
+    lines.append('%d books returned (average loan: %s days), %d lost (loss rate: %s)' % (report['returned'],
+        report['average_loan_days'] if report['average_loan_days'] is not None else '-', report['lost'],
+        '%.1f%%' % (report['loss_rate'] * 100) if report['loss_rate'] is not None else '-'))
+    return '\n'.join(lines)
+
+
+CSV_HEADER = ['month', 'statistic', 'label', 'value']
+
+
+def write_csv(reports, output):
+    """ Writes the reports to a file object, one row per figure """
+    writer = csv.writer(output)
+    writer.writerow(CSV_HEADER)
+    for report in reports:
+        month = report['month']
+        writer.writerow([month, 'borrows', '', report['borrows']])
+        for label, count in report['borrows_by_area'].items():
+            writer.writerow([month, 'borrows_by_area', label, count])
+        for label, count in report['borrows_by_genre'].items():
+            writer.writerow([month, 'borrows_by_genre', label, count])
+        for statistic in ('returned', 'lost', 'average_loan_days', 'loss_rate'):
+            writer.writerow([month, statistic, '', '' if report[statistic] is None else report[statistic]])
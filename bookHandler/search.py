@@ -0,0 +1,173 @@
+""" Full-text search over the catalogue.
+
+The index is a plain table (SearchToken) holding one row per (token, abstract book), with a weight depending on
+where the token was found. It is kept in sync by the signal handlers below, so a search is a single indexed
+GROUP BY on the tokens of the query instead of a scan of the book / author / genre tables.
+Inside a database transaction, the changed books are reindexed once each when it commits (e.g. a new book is saved,
+then gets its authors and genres), instead of once per signal.
+"""
+import re
+import unicodedata
+from collections import Counter
+from functools import reduce
+from operator import or_
+
+from django.db import transaction
+from django.db.models import Q, Sum, Max, Case, When, Value, IntegerField
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+
+from .models import AbstractBook, Author, Genre, SearchToken
+
+TITLE_WEIGHT = 5
+AUTHOR_WEIGHT = 4
+GENRE_WEIGHT = 2
+SUMMARY_WEIGHT = 1
+
+MAX_QUERY_TERMS = 10
+TOKEN_MAX_LENGTH = SearchToken._meta.get_field('token').max_length
+
+_word_re = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """ Splits a text into lower-case tokens, without accents (so that 'Émile' and 'emile' are the same token) """
+    if not text:
+        return []
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+    return [word[:TOKEN_MAX_LENGTH] for word in _word_re.findall(text)]
+
+
+def _book_tokens(book):
+    """ Returns the list of SearchToken rows (not saved) of one abstract book """
+    weights = Counter()
+    for token in tokenize(book.title):
+        weights[token] += TITLE_WEIGHT
+    for token in tokenize(book.summary):
+        weights[token] += SUMMARY_WEIGHT
+    for author in book.author.all():
+        for token in tokenize('%s %s' % (author.first_name, author.last_name)):
+            weights[token] += AUTHOR_WEIGHT
+    for genre in book.genre.all():
+        for token in tokenize(genre.name):
+            weights[token] += GENRE_WEIGHT
+    return [SearchToken(token=token, book=book, weight=weight) for (token, weight) in weights.items()]
+
+
+def index_books(book_ids):
+    """ (Re)computes the search tokens of several books with a constant number of queries """
+    book_ids = list(book_ids)
+    if not book_ids:
+        return
+    tokens = []
+    for book in AbstractBook.objects.filter(id__in=book_ids).prefetch_related('author', 'genre'):
+        tokens.extend(_book_tokens(book))
+    with transaction.atomic():
+        SearchToken.objects.filter(book__in=book_ids).delete()
+        SearchToken.objects.bulk_create(tokens, batch_size=500)
+
+
+def matching_books(query):
+    """ Returns a queryset of dicts {'book': id, 'score': relevance} of the books matching the query, the most relevant
+        first, or None if the query has no word. It can also be used as a subquery (e.g. id__in=...values('book')).
+        All the words of the query must be found in the book. The last word is matched as a prefix, so that partially
+        typed words already give results.
+    """
+    terms = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+    if not terms:
+        return None
+    conditions = [Q(token=term) for term in terms[:-1]]
+    # Prefix match expressed as a range so that the (token, book) index can be used
+    conditions.append(Q(token__gte=terms[-1], token__lt=terms[-1] + '\uffff'))
+
+    matches = {}
+    for i, condition in enumerate(conditions):
+        matches['match_%d' % i] = Max(Case(When(condition, then=Value(1)), default=Value(0), output_field=IntegerField()))
+    return (SearchToken.objects.filter(reduce(or_, conditions))
+        .values('book')
+        .annotate(score=Sum('weight'), **matches)
+        .filter(**{name: 1 for name in matches})
+        .order_by('-score', 'book'))
+
+
+def search_books(query, offset=0, limit=20):
+    """ Returns a tuple (list of AbstractBook ordered by relevance, has_more), see matching_books """
+    rows = matching_books(query)
+    if rows is None:
+        return [], False
+    book_ids = [row['book'] for row in rows[offset:offset+limit+1]]
+    has_more = len(book_ids) > limit
+    book_ids = book_ids[:limit]
+    books = AbstractBook.objects.prefetch_related('author').in_bulk(book_ids)
+    return [books[book_id] for book_id in book_ids if book_id in books], has_more
+
+
+# Signal handlers keeping the index up to date
+
+def _index_on_commit(book_ids):
+    """ Reindexes the books when the current transaction commits, at once outside of a transaction. The ids changed
+        during a transaction are collected on the connection and indexed together by the first callback run at the
+        commit, so a book saved several times is indexed once; the following callbacks find nothing left to do.
+        (A callback per call, because the one of a savepoint rolled back is dropped.)
+    """
+    book_ids = set(book_ids)
+    if not book_ids:
+        return
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        index_books(book_ids)
+        return
+    if getattr(connection, '_pending_search_ids', None) is None:
+        connection._pending_search_ids = set()
+    connection._pending_search_ids.update(book_ids)
+    transaction.on_commit(_index_pending)
+
+
+def _index_pending():
+    connection = transaction.get_connection()
+    pending_ids = getattr(connection, '_pending_search_ids', None)
+    connection._pending_search_ids = None
+    if pending_ids:
+        index_books(pending_ids)
+
+
+@receiver(post_save, sender=AbstractBook)
+def _index_saved_book(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _index_on_commit([instance.pk])
+
+
+@receiver(m2m_changed, sender=AbstractBook.author.through)
+@receiver(m2m_changed, sender=AbstractBook.genre.through)
+def _index_m2m_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # Clearing from the author / genre side: the books won't be known anymore after the clear
+        instance._search_book_ids = list(instance.abstractbook_set.values_list('id', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        _index_on_commit([instance.pk])
+    elif action == 'post_clear':
+        _index_on_commit(getattr(instance, '_search_book_ids', []))
+    else:
+        _index_on_commit(pk_set)
+
+
+@receiver(pre_delete, sender=Author)
+@receiver(pre_delete, sender=Genre)
+def _remember_indexed_books(sender, instance, **kwargs):
+    instance._search_book_ids = list(instance.abstractbook_set.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Genre)
+def _reindex_related_books(sender, instance, created=False, raw=False, **kwargs):
+    if not created and not raw:
+        _index_on_commit(instance.abstractbook_set.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Genre)
+def _reindex_books_after_delete(sender, instance, **kwargs):
+    _index_on_commit(getattr(instance, '_search_book_ids', []))
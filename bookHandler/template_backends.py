@@ -0,0 +1,26 @@
+""" Django template backend recording the time spent rendering, for the request metrics middleware """
+import time
+
+from django.template.backends.django import DjangoTemplates, Template
+
+from .metrics import record_template_time
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        start = time.perf_counter()
+        try:
+            return super(TimedTemplate,self).render(context, request)
+        finally:
+            record_template_time(time.perf_counter() - start)
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """ Same as the default DjangoTemplates backend, with the rendering time of each template measured """
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super(TimedDjangoTemplates,self).get_template(template_name)
+        return TimedTemplate(template.template, self)
@@ -0,0 +1,19 @@
+from django import template
+
+from bookHandler.fragment_cache import get_object_version, FRAGMENT_CACHE_TIMEOUT
+
+register = template.Library()
+
+
+@register.simple_tag
+def cache_version(obj):
+    """ Version of a model instance, to be used in the key of a {% cache %} fragment displaying it.
+        e.g. {% cache_version book as book_version %}{% cache fragment_timeout book_header book.id book_version %}
+    """
+    return get_object_version(obj)
+
+
+@register.simple_tag
+def cache_timeout():
+    """ Expiry time of the {% cache %} fragments (see fragment_cache.py): {% cache_timeout as fragment_timeout %} """
+    return FRAGMENT_CACHE_TIMEOUT
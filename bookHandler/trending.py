@@ -0,0 +1,78 @@
+""" Trending books: the titles most requested recently, recent requests counting more than older ones.
+
+Each borrowing request made in the last TRENDING_WINDOW_DAYS days counts 0.5 ** (age in days / TRENDING_HALF_LIFE_DAYS)
+for its title. The scores are computed by the database in one GROUP BY over the recent transactions (found through the
+created_date index), which also sorts them and only returns the top TRENDING_SIZE titles.
+
+The ranking is computed periodically by the 'compute_trending_books' job (see jobs.py) into the TrendingBook table, and
+kept in the cache, so displaying it costs one cache read (or one indexed read of the small table). The job runs in the
+worker process, whose cache deletion does not reach the per-process caches of the web processes: the cached ranking
+expires after TRENDING_CACHE_TIMEOUT, so they show a new ranking at most that long after it was computed.
+"""
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Sum, Case, When, Value, FloatField
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import AbstractBook, Transaction, TrendingBook
+
+TRENDING_SIZE = 10
+TRENDING_WINDOW_DAYS = 28
+TRENDING_HALF_LIFE_DAYS = 7
+
+TRENDING_CACHE_KEY = 'trending_books'
+TRENDING_CACHE_TIMEOUT = 5*60
+
+
+def trending_scores(today=None, size=TRENDING_SIZE, window_days=TRENDING_WINDOW_DAYS, half_life_days=TRENDING_HALF_LIFE_DAYS):
+    """ Returns the list of (abstract book id, score) of the trending books, best first """
+    today = today or timezone.localdate()
+    # The weight of a request only depends on its date: one CASE branch per day of the window
+    weight = Case(*[When(created_date=today - timedelta(days=age), then=Value(0.5 ** (age / half_life_days)))
+            for age in range(window_days)],
+        default=Value(0.0), output_field=FloatField())
+    return list(Transaction.objects
+        .filter(created_date__gt=today - timedelta(days=window_days), created_date__lte=today)
+        .order_by()
+        .values('book__abstract_book')
+        .annotate(score=Sum(weight))
+        .order_by('-score', 'book__abstract_book')
+        .values_list('book__abstract_book', 'score')[:size])
+
+
+def compute_trending_books(today=None):
+    """ Replaces the ranking in the TrendingBook table and in the cache. Returns the new ranking """
+    now = timezone.now()
+    scores = trending_scores(today)
+    with transaction.atomic():
+        TrendingBook.objects.all().delete()
+        TrendingBook.objects.bulk_create([TrendingBook(rank=rank, book_id=book_id, score=score, computed=now)
+            for rank, (book_id, score) in enumerate(scores, 1)])
+    cache.delete(TRENDING_CACHE_KEY)
+    return get_trending_books()
+
+
+def get_trending_books():
+    """ Returns {'computed': date of the ranking or None, 'books': [{'rank', 'id', 'title', 'score'}, ...]} """
+    trending = cache.get(TRENDING_CACHE_KEY)
+    if trending is None:
+        entries = list(TrendingBook.objects.select_related('book').only('rank', 'score', 'computed', 'book', 'book__title').order_by('rank'))
+        trending = {
+            'computed': entries[0].computed if entries else None,
+            'books': [{'rank': entry.rank, 'id': entry.book_id, 'title': entry.book.title, 'score': round(entry.score, 3)}
+                for entry in entries],
+        }
+        cache.set(TRENDING_CACHE_KEY, trending, TRENDING_CACHE_TIMEOUT)
+    return trending
+
+
+@receiver(post_save, sender=AbstractBook)
+@receiver(post_delete, sender=AbstractBook)
+def _book_changed(sender, instance, created=False, **kwargs):
+    # The cached ranking holds the titles (a deleted book is also removed from the table by the cascade)
+    if not created:
+        cache.delete(TRENDING_CACHE_KEY)
@@ -0,0 +1,82 @@
+""" Number of unread messages of each member, kept in the cache and updated incrementally.
+
+The counter is computed with one COUNT query (through the (destination, read) index) the first time it is needed,
+then kept up to date by the signal handlers below and by mark_conversation_read, so that displaying it on every page
+costs one cache read. Only the cache of the process making the change is updated (with the default per-process
+cache, the other web processes and the worker keep their own counters), and a message saved between the COUNT and the
+storing of its result is not counted: the counter expires after UNREAD_COUNT_TIMEOUT seconds, which bounds how long
+a count can stay wrong. A counter going below zero (e.g. a message read after the counter was computed without it) is
+deleted and computed again.
+
+The counter is only approximate with the shared 'file' and 'db' caches (CACHE_SHARED setting): their incr() and
+decr() read the value and write it back, so two concurrent changes can lose one, and the write restarts the cache
+default timeout instead of UNREAD_COUNT_TIMEOUT.
+"""
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Message
+
+UNREAD_COUNT_TIMEOUT = 60
+
+
+def _counter_key(user_id):
+    return 'unread_messages:%s' % user_id
+
+
+def get_unread_count(user_id):
+    key = _counter_key(user_id)
+    count = cache.get(key)
+    if count is None:
+        count = Message.objects.filter(destination=user_id, read=False).count()
+        cache.add(key, count, UNREAD_COUNT_TIMEOUT)
+    return max(count, 0)
+
+
+def _add_to_counter(user_id, delta):
+    key = _counter_key(user_id)
+    try:
+        if delta > 0:
+            cache.incr(key, delta)
+        elif delta < 0 and cache.decr(key, -delta) < 0:
+            # The counter missed an increment
+            cache.delete(key)
+    except ValueError:
+        # Counter not in the cache: it will be computed from the database when needed
+        pass
+
+
+def mark_conversation_read(transaction_id, user_id):
+    """ Marks as read all the messages of a transaction sent to the given user """
+    nr_read = Message.objects.filter(transaction=transaction_id, destination=user_id, read=False).update(read=True)
+    _add_to_counter(user_id, -nr_read)
+    return nr_read
+
+
+def messages_created(messages):
+    """ Updates the counters after a bulk_create of messages, which does not send the post_save signals """
+    new_unread = {}
+    for message in messages:
+        if message.destination_id is not None and not message.read:
+            new_unread[message.destination_id] = new_unread.get(message.destination_id, 0) + 1
+    for user_id, nr_messages in new_unread.items():
+        _add_to_counter(user_id, nr_messages)
+
+
+@receiver(post_save, sender=Message)
+def _message_saved(sender, instance, created=False, **kwargs):
+    if instance.destination_id is None:
+        return
+    if created:
+        if not instance.read:
+            _add_to_counter(instance.destination_id, 1)
+    else:
+        # The read flag or the destination may have changed: recomputing the counter
+        cache.delete(_counter_key(instance.destination_id))
+
+
+@receiver(post_delete, sender=Message)
+def _message_deleted(sender, instance, **kwargs):
+    if instance.destination_id is not None and not instance.read:
+        _add_to_counter(instance.destination_id, -1)
@@ -1,5 +1,5 @@
 # urls for the bookHandler app
-from . import views
+from . import views, api
 from django.urls import path
 
 app_name='bookHandler'
@@ -8,13 +8,31 @@ urlpatterns=[
     path('detail/<int:book_id>/', views.abstract_detailed_view, name='detail_abstract'),
     path('detail_actual/<uuid:book_id>/', views.actualBook_detailed_view, name='detail_actual'),
     path('author/<int:author_id>/', views.author_detailed_view, name='detail_author'),
+    path('search', views.search_view, name='search'),
+    path('available', views.available_copies_view, name='available_copies'),
     path('new_book', views.add_book_view, name='add_book'),
     path('user_profile',views.profile_view, name='user_profile'),
     path('new_transaction/<uuid:book_id>', views.new_borrowing_request, name='new_transaction'),
     path('reply_transaction/<uuid:transaction_id>',views.reply_request, name='reply_transaction'),
     path('edit_transaction/<uuid:transaction_id>', views.edit_transaction, name='edit_transaction'),
     path('view_conversation/<uuid:transaction_id>', views.view_conversation, name='view_conversation'),
+    path('view_conversation/<uuid:transaction_id>/updates', views.conversation_updates, name='conversation_updates'),
     path('my_books', views.my_books_view, name='user_books'),
     path('my_requests', views.my_requests_view, name='user_requests'),
+    path('inbox', views.inbox_view, name='inbox'),
+    path('metrics', views.metrics_view, name='metrics'),
+    # JSON API, see api.py
+    path('api/token', api.token, name='api_token'),
+    path('api/books', api.books, name='api_books'),
+    path('api/books/<int:book_id>', api.book, name='api_book'),
+    path('api/books/trending', api.trending_books, name='api_trending_books'),
+    path('api/authors', api.authors, name='api_authors'),
+    path('api/authors/<int:author_id>', api.author, name='api_author'),
+    path('api/copies', api.copies, name='api_copies'),
+    path('api/copies/<uuid:copy_id>', api.copy, name='api_copy'),
+    path('api/transactions', api.transactions, name='api_transactions'),
+    path('api/transactions/<uuid:transaction_id>', api.transaction_detail, name='api_transaction'),
+    path('api/messages', api.messages, name='api_messages'),
+    path('api/messages/<uuid:message_id>', api.message, name='api_message'),
 ]
 
@@ -1,47 +1,161 @@
 from django.shortcuts import render,redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Q, OuterRef, Subquery, Count, Case, When, Value, IntegerField
+from django.core.exceptions import ValidationError
+from django.db.models.functions import Coalesce
 from django.contrib.auth import login, authenticate # In order to login new users after registration
 
 from .models import AbstractBook, ActualBook, Genre, Author, Transaction, Message
-from django.contrib.auth.models import User
+from .models import User
 from .forms import UserBookForm, RegisterForm, TransactionReplyForm, EditTransactionForm, NewMessageForm
+from .search import search_books, matching_books
+from . import metrics
+from .unread import mark_conversation_read
+from .trending import get_trending_books
+from .recommendations import related_books
+from .jobs import enqueue, enqueue_once, queue_stats
+from .fragment_cache import get_version, CATALOGUE, FRAGMENT_CACHE_TIMEOUT, SHARED_CACHE
+from .conditional import conditional_catalogue_page, book_index_state, abstract_book_state, author_state
+from django.core.cache import cache
 
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.formats import date_format
+from django.http import JsonResponse
 from datetime import datetime, timedelta 
+import uuid
 
 # Create your views here.
 
+# Number of books displayed per page on the index. Pagination is keyset based (on the book id)
+# so that the cost of a page does not depend on how deep in the catalogue the user is.
+BOOK_INDEX_PAGE_SIZE = 50
+
+@conditional_catalogue_page(book_index_state)
 def book_index(request):
-    all_book_list = AbstractBook.objects.all()
+    after = request.GET.get('after', '')
+    before = request.GET.get('before', '')
+    # The page content only changes with the catalogue, so it is cached until the catalogue version is bumped
+    cache_key = _book_index_cache_key(after, before)
+    context = cache.get(cache_key)
+    if context is None:
+        context = _book_index_page(after, before)
+        cache.set(cache_key, context, FRAGMENT_CACHE_TIMEOUT)
+    # The trending books are precomputed by a periodic job (see trending.py), only the first page shows them
+    if not after and not before:
+        context = dict(context, trending_books=get_trending_books()['books'])
+    return render(request, 'bookHandler/books-index.html', context)
+
+def _book_index_cache_key(after, before):
+    return 'book_index:%s:%s:%d:%d' % (after if after.isdigit() else '', before if before.isdigit() else '',
+        BOOK_INDEX_PAGE_SIZE, get_version(CATALOGUE))
+
+def _book_index_page(after, before):
+    books = AbstractBook.objects.prefetch_related('author')
+    if before.isdigit():
+        # Going backwards: we take the page just before the cursor and reverse it afterwards
+        page = list(books.filter(id__lt=int(before)).order_by('-id')[:BOOK_INDEX_PAGE_SIZE+1])
+        has_more = len(page) > BOOK_INDEX_PAGE_SIZE
+        page = page[:BOOK_INDEX_PAGE_SIZE][::-1]
+        previous_cursor = page[0].id if has_more else None
+        next_cursor = page[-1].id if page else None
+    else:
+        if after.isdigit():
+            books = books.filter(id__gt=int(after))
+        page = list(books.order_by('id')[:BOOK_INDEX_PAGE_SIZE+1])
+        has_more = len(page) > BOOK_INDEX_PAGE_SIZE
+        page = page[:BOOK_INDEX_PAGE_SIZE]
+        previous_cursor = page[0].id if (page and after.isdigit()) else None
+        next_cursor = page[-1].id if has_more else None
     book_list_with_author = []
-    for book in all_book_list:
+    for book in page:
+        # book.author.all() is served from the prefetch cache, no extra query here
         book_list_with_author.append( (book,','.join([str(author) for author in book.author.all()])) )
-    return render(request, 'bookHandler/books-index.html', {'book_list_with_author': book_list_with_author })
+    return {
+        'book_list_with_author': book_list_with_author,
+        'next_cursor': next_cursor,
+        'previous_cursor': previous_cursor,
+    }
+
+AVAILABILITY_SIZE = 50
+
+def available_copies_view(request):
+    # Available copies of one title ('book' parameter) or of the titles matching a search ('q' parameter), the ones
+    # owned by members living in the same area as the requester first, then the ones in the same town.
+    # The copies, their owners and their titles come from one query.
+    book_id = request.GET.get('book', '')
+    query = request.GET.get('q', '').strip()
+    copies = (ActualBook.objects.filter(status=ActualBook.AVAILABLE)
+        .select_related('owner', 'abstract_book'))
+    if book_id.isdigit():
+        copies = copies.filter(abstract_book=int(book_id))
+    else:
+        matching = matching_books(query)
+        copies = copies.filter(abstract_book__in=matching.values('book')) if matching is not None else copies.none()
+    if request.user.is_authenticated:
+        location = request.user.location
+        copies = copies.exclude(owner=request.user).annotate(distance=Case(
+            When(owner__location=location, then=Value(0)),
+            When(owner__location__startswith=location[:1], then=Value(1)),
+            default=Value(2), output_field=IntegerField()))
+    else:
+        location = None
+        copies = copies.annotate(distance=Value(0, output_field=IntegerField()))
+    copies = copies.order_by('distance', 'abstract_book__title', '-created_date')[:AVAILABILITY_SIZE]
+    context = {
+        'copy_list': copies,
+        'query': query,
+        'book_id': book_id,
+        'location': dict(User.AREA_LOCATIONS).get(location),
+    }
+    return render(request, 'bookHandler/available-copies.html', context)
+
+SEARCH_PAGE_SIZE = 20
+# The database goes through all the matches of the previous pages (OFFSET), so the deep pages are not served
+SEARCH_MAX_PAGE = 50
+
+def search_view(request):
+    query = request.GET.get('q', '').strip()
+    page = request.GET.get('page', '1')
+    page = min(int(page[:6]), SEARCH_MAX_PAGE) if page.isdigit() and int(page[:6]) > 0 else 1
+    book_list, has_more = search_books(query, offset=(page-1)*SEARCH_PAGE_SIZE, limit=SEARCH_PAGE_SIZE)
+    context = {
+        'query': query,
+        'book_list': book_list,
+        'page': page,
+        'previous_page': page-1 if page > 1 else None,
+        'next_page': page+1 if has_more and page < SEARCH_MAX_PAGE else None,
+    }
+    return render(request, 'bookHandler/search-results.html', context)
 
 # Main view: List of all actual books available, including user name
 def home_view(request):
     pass
 
 # Detailed view of an actual book: Details about the abstract book, the status / quality of the actual book, details about the user and list of transactions
+@conditional_catalogue_page(abstract_book_state)
 def abstract_detailed_view(request, book_id):
-    abstract_book = AbstractBook.objects.get(id=book_id)
-    # TO DO - look at case when the book doesn't exist
+    abstract_book = get_object_or_404(AbstractBook, id=book_id)
     genre_list = abstract_book.genre.all()
     actual_list = abstract_book.instances.all()
     author_list = abstract_book.author.all()
+    # Precomputed by the 'refresh_related_books' job (see recommendations.py)
+    related_list = related_books(abstract_book.id)
 
     context = { 'book' : abstract_book, 
         'actual_list' : actual_list ,
         'genre_list' : genre_list,
         'author_list' : author_list,
+        'related_list' : related_list,
         }
     return render(request, 'bookHandler/detailed-abstract-book.html', context)
 
 
 def actualBook_detailed_view(request, book_id):
-    actual_book = get_object_or_404(ActualBook, id=book_id)
+    actual_book = get_object_or_404(ActualBook.objects.select_related('abstract_book', 'owner'), id=book_id)
     abstract_book = actual_book.abstract_book
     transaction_list = actual_book.transactions.all()
 
@@ -55,6 +169,7 @@ def actualBook_detailed_view(request, book_id):
 
 
 # Showing the author profile, a bio, a list of books (and availability of some stuff)
+@conditional_catalogue_page(author_state)
 def author_detailed_view(request, author_id):
     author = get_object_or_404(Author, pk=author_id)
     book_list = AbstractBook.objects.filter(author=author)
@@ -71,12 +186,16 @@ def add_book_view(request):
         if newBookForm.is_valid():
             # Check if the abstract book already exists
             author_list_string = newBookForm.cleaned_data['author'].split(',')
-            new_abstract_book = AbstractBook.get_or_create(newBookForm.cleaned_data['title'],author_list_string)
+            new_abstract_book = AbstractBook.get_or_create(newBookForm.cleaned_data['title'],author_list_string, isbn=newBookForm.cleaned_data['isbn'])
             # Now we create a new Actual Book
             new_actual_book = ActualBook()
             new_actual_book.abstract_book = new_abstract_book
             new_actual_book.owner = request.user
             new_actual_book.save()
+            # The new book changed the catalogue version: the first page of the index is computed again in the background,
+            # when the worker shares its cache with the web processes
+            if SHARED_CACHE:
+                enqueue_once('warm_book_index')
             return redirect('bookHandler:index')
         else:
             return redirect('bookHandler:index')
@@ -102,12 +221,21 @@ def profile_view(request):
 
 @login_required
 def my_books_view(request):
-    personal_inventory = ActualBook.objects.filter(owner=request.user).order_by('status','abstract_book__title')
+    # The id of the latest transaction of each book is computed by a subquery, so that the page costs the same
+    # number of queries whatever the number of books
+    latest_transaction = Transaction.objects.filter(book=OuterRef('pk')).order_by('-modified_timestamp').values('id')[:1]
+    personal_inventory = (ActualBook.objects.filter(owner=request.user)
+        .select_related('abstract_book')
+        .prefetch_related('abstract_book__author')
+        .annotate(current_transaction_id=Subquery(latest_transaction))
+        .order_by('status','abstract_book__title'))
+    personal_inventory = list(personal_inventory)
+    transaction_ids = [book.current_transaction_id for book in personal_inventory if book.status == book.OUT_FOR_RENT and book.current_transaction_id]
+    current_transactions = Transaction.objects.select_related('borrower').in_bulk(transaction_ids)
     book_list = []
     for book in personal_inventory:
         if book.status == book.OUT_FOR_RENT:
-            current_transaction = Transaction.objects.filter(Q(book=book)).order_by('-modified_timestamp')[0]
-            book_list.append((book,current_transaction))
+            book_list.append((book,current_transactions.get(book.current_transaction_id)))
         else:
             book_list.append((book,None))
     
@@ -138,26 +266,21 @@ def register(request):
 @login_required
 def new_borrowing_request(request, book_id):
     # the current user logged wants to borrow the given book.
-    # We have to check if the book is still available.
-    # If everything is OK, we have to create a new transaction in 'request' mode and connect all the dots.
-    # In the future, we will be able to send an e-mail of new notification to the lender.
+    # Transaction.create_request checks and reserves the book in one atomic step, so that two members requesting
+    # the same book at the same time cannot both get it.
+    # The e-mail notifying the lender is sent by a background job (see jobs.py), not while the member waits.
+    actualbook = get_object_or_404(ActualBook,id=book_id)
     if request.method == 'POST':
-        actualbook = get_object_or_404(ActualBook,id=book_id)
-        if actualbook.status == ActualBook.AVAILABLE:
-            book_owner = actualbook.owner
-            if not book_owner == request.user:
-                new_request = Transaction(book=actualbook, lender=book_owner, borrower=request.user, 
-                    lend_date=timezone.now() + timedelta(days=7), 
-                    return_date=timezone.now() + timedelta(days=37) )
-                new_request.transaction_state = Transaction.INITIAL_REQUEST
-                new_request.save()
-                actualbook.status = ActualBook.OUT_FOR_RENT # We will put it unavailable until the owner denies the request or the book is given back
-                actualbook.save()
-                messages.success(request, 'Book successfully borrowed!')
+        try:
+            with transaction.atomic():
+                new_request = Transaction.create_request(actualbook, request.user)
+                enqueue('notify_new_request', transaction_id=str(new_request.id))
+            messages.success(request, 'Book successfully borrowed!')
+        except ValidationError as e:
+            if e.code == 'own_book':
+                messages.warning(request, e.message)
             else:
-                messages.warning(request, 'You cannot borrow your own books!')
-        else:
-            messages.error(request, 'This book is not available')
+                messages.error(request, e.message)
     else:
         messages.error(request,'Error in the HTTP Request')
     return redirect(actualbook)
@@ -174,11 +297,16 @@ def reply_request(request, transaction_id):
         form = TransactionReplyForm(request.POST)
         if form.is_valid():
             owner_reply = form.cleaned_data['owner_reply']
-            if owner_reply=='Yes':
-                book_transaction.transaction_state = Transaction.APPROVED_REQUEST
-            else:
-                book_transaction.transaction_state = Transaction.REJECTED_REQUEST
-            book_transaction.save()
+            with transaction.atomic():
+                # Locking the transaction so that two concurrent replies are applied one after the other
+                book_transaction = Transaction.objects.select_for_update().select_related('book').get(id=transaction_id)
+                try:
+                    book_transaction.change_state(Transaction.APPROVED_REQUEST if owner_reply=='Yes' else Transaction.REJECTED_REQUEST)
+                except ValidationError as e:
+                    messages.error(request, e.message)
+                    return redirect(request.user)
+                book_transaction.save()
+                book_transaction.update_actual_book_status()
             if form.cleaned_data['message'] != '':
                 new_message = Message(author=request.user,destination=book_transaction.borrower, transaction=book_transaction,text=form.cleaned_data['message'])
                 new_message.save()
@@ -200,28 +328,32 @@ def edit_transaction(request, transaction_id):
         return redirect(request.user)
 
     if request.method == 'POST':
-        form = EditTransactionForm(request.POST)
-        book_transaction = get_object_or_404(Transaction, id=transaction_id)
-        if form.is_valid():   
-            book_transaction.lend_date = form.cleaned_data['lend_date']
-            book_transaction.return_date = form.cleaned_data['return_date']
-            book_transaction.transaction_state = form.cleaned_data['transaction_state']
-            book_transaction.save()
-            book_transaction.update_actual_book_status()
+        with transaction.atomic():
+            # Locking the transaction so that the state checked by the form is still the current one when saving
+            book_transaction = Transaction.objects.select_for_update().select_related('book').get(id=transaction_id)
+            # The form only accepts the states allowed after the current one (see Transaction.ALLOWED_TRANSITIONS)
+            form = EditTransactionForm(request.POST, instance=book_transaction)
+            if form.is_valid():
+                book_transaction.lend_date = form.cleaned_data['lend_date']
+                book_transaction.return_date = form.cleaned_data['return_date']
+                book_transaction.transaction_state = form.cleaned_data['transaction_state']
+                book_transaction.save()
+                book_transaction.update_actual_book_status()
+        if form.is_valid():
             # Looking at the comment
             if form.cleaned_data['new_message'] != '':
                 new_message = Message(author=request.user,destination=book_transaction.borrower, transaction=book_transaction,text=form.cleaned_data['new_message'])
                 new_message.save()
             return redirect(request.user)
         else:
+            book_transaction.refresh_from_db()
             return render(request, 'bookHandler/edit-transaction.html', {'transaction': book_transaction, 'transaction_form':form })            
     else:
-        book_transaction = get_object_or_404(Transaction, id=transaction_id)
         form = EditTransactionForm(instance=book_transaction)
-        # TO DO -> Restricing the possibilities of the new "Transaction Status" according to the current transaction status
-
         return render(request, 'bookHandler/edit-transaction.html', {'transaction': book_transaction, 'transaction_form':form })
 
+CONVERSATION_PAGE_SIZE = 30
+
 @login_required
 def view_conversation(request, transaction_id):
     book_transaction = get_object_or_404(Transaction, id=transaction_id)
@@ -233,9 +365,116 @@ def view_conversation(request, transaction_id):
         form = NewMessageForm(request.POST)
         if form.is_valid():
             if form.cleaned_data['message_text'] != '':
-                new_message = Message(author=request.user,destination=book_transaction.borrower, transaction=book_transaction,text=form.cleaned_data['message_text'])
+                # The message goes to the other participant of the transaction
+                destination = book_transaction.borrower if request.user == book_transaction.lender else book_transaction.lender
+                new_message = Message(author=request.user,destination=destination, transaction=book_transaction,text=form.cleaned_data['message_text'])
                 new_message.save()
     
     form = NewMessageForm()
-    message_list = Message.objects.filter(transaction=transaction_id).all()
-    return render(request, 'bookHandler/view-conversation.html', {'transaction': book_transaction, 'message_list':message_list, 'new_message_form':form, })
\ No newline at end of file
+    mark_conversation_read(transaction_id, request.user.id)
+    # Keyset pagination on (timestamp, id), the latest messages first: the 'before' / 'before_id' parameters are the
+    # last message of the previous page
+    message_list = Message.objects.filter(transaction=transaction_id).select_related('author', 'destination').order_by('-timestamp', '-id')
+    before = parse_datetime(request.GET.get('before', ''))
+    before_id = request.GET.get('before_id', '')
+    is_latest_page = before is None
+    if not is_latest_page:
+        if timezone.is_naive(before):
+            before = timezone.make_aware(before)
+        try:
+            before_id = uuid.UUID(before_id)
+            message_list = message_list.filter(Q(timestamp__lt=before) | Q(timestamp=before, id__lt=before_id))
+        except ValueError:
+            message_list = message_list.filter(timestamp__lt=before)
+    message_list = list(message_list[:CONVERSATION_PAGE_SIZE+1])
+    older_cursor = message_list[CONVERSATION_PAGE_SIZE-1] if len(message_list) > CONVERSATION_PAGE_SIZE else None
+    message_list = message_list[:CONVERSATION_PAGE_SIZE]
+    context = {
+        'transaction': book_transaction,
+        'message_list': message_list,
+        'new_message_form': form,
+        'poll_after': timezone.now() - CONVERSATION_COMMIT_MARGIN,
+        'is_latest_page': is_latest_page,
+        'older_cursor': older_cursor,
+        'poll_interval': CONVERSATION_POLL_INTERVAL * 1000,
+    }
+    return render(request, 'bookHandler/view-conversation.html', context)
+
+INBOX_SIZE = 50
+
+@login_required
+def inbox_view(request):
+    # All the conversations of the user, most recent first, with a preview of their last message.
+    # Everything comes from a single query: the last message and the unread count are subqueries.
+    conversation_messages = Message.objects.filter(transaction=OuterRef('pk')).order_by('-timestamp')
+    unread_count = (Message.objects.filter(transaction=OuterRef('pk'), destination=request.user, read=False)
+        .order_by().values('transaction').annotate(count=Count('id')).values('count'))
+    conversation_list = (Transaction.objects.filter(Q(lender=request.user)|Q(borrower=request.user))
+        .select_related('book__abstract_book', 'lender', 'borrower')
+        .annotate(last_message_text=Subquery(conversation_messages.values('text')[:1]),
+            last_message_timestamp=Subquery(conversation_messages.values('timestamp')[:1]),
+            last_message_author=Subquery(conversation_messages.values('author__username')[:1]),
+            unread_count=Coalesce(Subquery(unread_count), 0))
+        .filter(last_message_timestamp__isnull=False)
+        .order_by('-last_message_timestamp')[:INBOX_SIZE])
+    return render(request, 'bookHandler/inbox.html', {'conversation_list': conversation_list})
+
+# Interval (in seconds) between two conversation update requests of the conversation page
+CONVERSATION_POLL_INTERVAL = 5
+# A message is stamped before its database transaction commits, so it can appear after a message stamped later. The
+# updates cursor stays this far behind the current time, and the page skips the messages it already shows.
+CONVERSATION_COMMIT_MARGIN = timedelta(seconds=10)
+
+@login_required
+def conversation_updates(request, transaction_id):
+    # Polled by the conversation page: returns the messages after the ('after', 'after_id') keyset cursor, read
+    # through the (transaction, timestamp) index, and the cursor of the next request. The request answers at once, so
+    # it never holds a worker while waiting.
+    book_transaction = get_object_or_404(Transaction, id=transaction_id)
+    if request.user.id != book_transaction.lender_id and request.user.id != book_transaction.borrower_id:
+        return JsonResponse({'error': 'You are not participating into this transaction'}, status=403)
+    after = parse_datetime(request.GET.get('after', ''))
+    if after is None:
+        return JsonResponse({'error': 'Invalid or missing "after" timestamp'}, status=400)
+    if timezone.is_naive(after):
+        after = timezone.make_aware(after)
+    try:
+        after_id = uuid.UUID(request.GET['after_id']) if request.GET.get('after_id') else None
+    except ValueError:
+        return JsonResponse({'error': 'Invalid "after_id"'}, status=400)
+
+    message_list = Message.objects.filter(transaction=transaction_id).select_related('author', 'destination').order_by('timestamp', 'id')
+    if after_id is None:
+        message_list = message_list.filter(timestamp__gte=after)
+    else:
+        message_list = message_list.filter(Q(timestamp__gt=after) | Q(timestamp=after, id__gt=after_id))
+    message_list = list(message_list)
+    if message_list:
+        mark_conversation_read(transaction_id, request.user.id)
+    # The cursor only moves past the messages which can't be preceded by a message still being committed
+    settled = timezone.now() - CONVERSATION_COMMIT_MARGIN
+    for message in message_list:
+        if message.timestamp < settled:
+            after, after_id = message.timestamp, message.id
+    return JsonResponse({
+        'messages': [{
+            'id': str(message.id),
+            'author': str(message.author) if message.author else 'Niseko Book Club',
+            'destination': str(message.destination),
+            'mine': message.author_id == request.user.id,
+            'text': message.text,
+            'timestamp': message.timestamp.isoformat(),
+            'display_timestamp': date_format(timezone.localtime(message.timestamp), 'DATETIME_FORMAT'),
+        } for message in message_list],
+        'last_timestamp': after.isoformat(),
+        'last_id': str(after_id) if after_id else '',
+    })
+
+@staff_member_required
+def metrics_view(request):
+    # Hottest endpoints of this server process, measured by the RequestMetricsMiddleware
+    if request.method == 'POST':
+        metrics.reset()
+        return redirect('bookHandler:metrics')
+    return render(request, 'bookHandler/metrics.html', {'endpoint_list': metrics.summary(), 'window': metrics.WINDOW,
+        'job_stats': queue_stats()})
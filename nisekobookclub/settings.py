@@ -13,6 +13,8 @@ https://docs.djangoproject.com/en/2.2/ref/settings/
 import os
 from decouple import config, Csv
 
+from bookHandler.database import database_from_url, replica_from_url, REPLICA_PREFIX
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -38,10 +40,13 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'bookHandler',
+    'bookHandler.apps.BookhandlerConfig',
 ]
 
 MIDDLEWARE = [
+    'bookHandler.middleware.RequestMetricsMiddleware',
+    'bookHandler.middleware.DatabaseHealthCheckMiddleware',
+    'bookHandler.middleware.ReplicaPinningMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -55,7 +60,8 @@ ROOT_URLCONF = 'nisekobookclub.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Same as django.template.backends.django.DjangoTemplates, with the rendering time measured
+        'BACKEND': 'bookHandler.template_backends.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -64,6 +70,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'bookHandler.context_processors.unread_messages',
             ],
         },
     },
@@ -75,12 +82,93 @@ WSGI_APPLICATION = 'nisekobookclub.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
 
+# DATABASE_URL selects the database (see bookHandler/database.py for the syntax), by default the SQLite file next to
+# manage.py. DATABASE_REPLICA_URLS, separated by commas, are read replicas serving the catalogue pages.
+# Connections are kept CONN_MAX_AGE seconds between requests (0 closes them after each request). By default they are
+# only kept with a database server: opening a SQLite file is cheaper than checking a kept connection at each request.
+
+DATABASE_URL = config('DATABASE_URL', default='sqlite:///' + os.path.join(BASE_DIR, 'db.sqlite3'))
+DATABASE_REPLICA_URLS = config('DATABASE_REPLICA_URLS', default='', cast=Csv())
+CONN_MAX_AGE = config('CONN_MAX_AGE', default=0 if DATABASE_URL.startswith('sqlite') else 60, cast=int)
+DATABASE_OPTIONS = {
+    'conn_max_age': CONN_MAX_AGE,
+    # Only used with SQLite: WAL journal ('DELETE' for the SQLite default) and seconds a writer waits for the lock
+    'sqlite_journal_mode': config('SQLITE_JOURNAL_MODE', default='WAL'),
+    'sqlite_busy_timeout': config('SQLITE_BUSY_TIMEOUT', default=20, cast=int),
+}
+
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+    'default': database_from_url(DATABASE_URL, **DATABASE_OPTIONS),
 }
+for replica_number, replica_url in enumerate(DATABASE_REPLICA_URLS):
+    DATABASES['%s%d' % (REPLICA_PREFIX, replica_number+1)] = replica_from_url(replica_url, **DATABASE_OPTIONS)
+if DATABASE_REPLICA_URLS:
+    DATABASE_ROUTERS = ['bookHandler.database.PrimaryReplicaRouter']
+
+
+# Cache
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+# CACHE_SHARED selects a cache shared by all the processes ('file' or 'db', the latter needing 'manage.py createcachetable').
+# When set, each process keeps a local memory copy of the values for CACHE_LOCAL_TIMEOUT seconds in front of it.
+# Without it, each process only has its own local memory cache, and the cached pages of a process may show a change made
+# by another one up to a minute late (see bookHandler/fragment_cache.py).
+
+CACHE_SHARED = config('CACHE_SHARED', default='')
+CACHE_LOCATION = config('CACHE_LOCATION', default='')
+CACHE_LOCAL_TIMEOUT = config('CACHE_LOCAL_TIMEOUT', default=5, cast=int)
+
+CACHES = {
+    'local': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'nisekobookclub-local',
+        'OPTIONS': {'MAX_ENTRIES': config('CACHE_LOCAL_MAX_ENTRIES', default=5000, cast=int)},
+    },
+}
+if CACHE_SHARED == 'file':
+    CACHES['shared'] = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': CACHE_LOCATION or os.path.join(BASE_DIR, 'cache'),
+    }
+elif CACHE_SHARED == 'db':
+    CACHES['shared'] = {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': CACHE_LOCATION or 'django_cache',
+    }
+if 'shared' in CACHES:
+    CACHES['default'] = {
+        'BACKEND': 'bookHandler.cache_backends.TieredCache',
+        'OPTIONS': {'LOCAL': 'local', 'SHARED': 'shared', 'LOCAL_TIMEOUT': CACHE_LOCAL_TIMEOUT},
+    }
+else:
+    CACHES['default'] = CACHES['local']
+
+# Sessions are read from the cache and only written through to the database
+SESSION_ENGINE = config('SESSION_ENGINE', default='django.contrib.sessions.backends.cached_db')
+
+
+# Number of requests kept per URL name for the request metrics (see bookHandler/metrics.py)
+REQUEST_METRICS_WINDOW = config('REQUEST_METRICS_WINDOW', default=1000, cast=int)
+
+# Number of seconds a browser or a reverse proxy can reuse the catalogue pages seen by anonymous visitors without
+# revalidating them (see bookHandler/conditional.py)
+CATALOGUE_MAX_AGE = config('CATALOGUE_MAX_AGE', default=60, cast=int)
+
+# Number of seconds after which a background job still running is considered lost (its worker was killed) and queued
+# again. Longer than the slowest job; the tasks rebuilding whole tables have their own, longer, timeout (see
+# bookHandler/jobs.py)
+JOB_STALE_TIMEOUT = config('JOB_STALE_TIMEOUT', default=60*60, cast=int)
+
+
+# E-mails are sent by the background jobs (see bookHandler/jobs.py). By default they are only printed by the worker;
+# use django.core.mail.backends.filebased.EmailBackend with EMAIL_FILE_PATH to keep them, or the smtp backend.
+EMAIL_BACKEND = config('EMAIL_BACKEND', default='django.core.mail.backends.console.EmailBackend')
+EMAIL_FILE_PATH = config('EMAIL_FILE_PATH', default=os.path.join(BASE_DIR, 'sent_emails'))
+EMAIL_HOST = config('EMAIL_HOST', default='localhost')
+EMAIL_PORT = config('EMAIL_PORT', default=25, cast=int)
+EMAIL_HOST_USER = config('EMAIL_HOST_USER', default='')
+EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD', default='')
+EMAIL_USE_TLS = config('EMAIL_USE_TLS', default=False, cast=bool)
+DEFAULT_FROM_EMAIL = config('DEFAULT_FROM_EMAIL', default='Niseko Book Club <noreply@nisekobookclub.local>')
 
 
 # Password validation